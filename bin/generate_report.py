@@ -13,7 +13,12 @@ import logging.handlers
 import logging.config
 import re
 import calendar
-import shutil
+import bisect
+import itertools
+import heapq
+import threading
+import hashlib
+import math
 import glob  # Unix style pathname pattern expansion
 
 # Add mios-report LIB to path
@@ -25,10 +30,29 @@ sys.path.append(mreport_home + '/lib')
 
 from zabbix_api import ZabbixAPI, ZabbixAPIException
 import GChartWrapper
+# NumPy is optional. It is only used when uptime_engine is set to numpy
+try:
+    import numpy
+except ImportError:
+    numpy = None
+# pytz is optional. It is only used for SLA calendars with a timezone
+try:
+    import pytz
+except ImportError:
+    pytz = None
+# PIL is optional. It is only used when graph_renderer is set to local
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = ImageDraw = ImageFont = None
 
 
 postgres = None
 zapi = None
+maintenance_cache = None
+graph_fetcher = None
+sla_calendar_cache = {}
+item_info_cache = {}
 
 class Config:
     def __init__(self, conf_file, customer_conf_file):
@@ -39,6 +63,22 @@ class Config:
         self.zabbix_password = ''
         self.postgres_dbname = ''
         self.postgres_dbs = {}
+        self.postgres_itersize = 10000
+        self.uptime_engine = 'python'
+        self.uptime_rollup = 0
+        self.uptime_trends_threshold = 0
+        self.uptime_down_islands = 0
+        self.uptime_workers = 1
+        self.sla_calendars = {}
+        self.uptime_interval_profiles = 0
+        self.uptime_interval_profile_age = 7
+        self.uptime_result_cache = 0
+        self.uptime_result_cache_horizon = 24
+        self.uptime_recompute = False
+        self.graph_max_requests = 4
+        self.graph_cache_dir = ''
+        self.graph_cache_max_size = 1024
+        self.graph_cache_max_age = 90
         self.hostgroupid = None
         self.in_test = 0
         self.report_name = ''
@@ -48,9 +88,14 @@ class Config:
         self.report_trend_start = ''
         self.report_trend_period = ''
         self.report_graph_width = ''
+        self.report_graph_renderer = 'frontend'
         self.report_title = ''
         self.report_backup_item = None
         self.report_infra_picture = ''
+        self.uptime_source = 'history'
+        self.uptime_windows = []
+        self.sla_calendar = None
+        self.uptime_heatmap = ''
         self.custom_section = 0
         self.custom_title = ''
         self.table_header_color = ''
@@ -110,6 +155,68 @@ class Config:
         except:
             postgres_password = 'postgres'
         self.postgres_dbs[self.postgres_dbname] = (postgres_host, postgres_port, postgres_user, postgres_password)
+        try:
+            self.postgres_itersize = int(self.config.get('miosdb', 'itersize'))
+        except:
+            self.postgres_itersize = 10000
+        try:
+            self.uptime_engine = self.config.get('common', 'uptime_engine')
+        except:
+            self.uptime_engine = 'python'
+        try:
+            self.uptime_rollup = int(self.config.get('common', 'uptime_rollup'))
+        except:
+            self.uptime_rollup = 0
+        try:
+            self.uptime_trends_threshold = int(self.config.get('common', 'uptime_trends_threshold'))
+        except:
+            self.uptime_trends_threshold = 0
+        try:
+            self.uptime_down_islands = int(self.config.get('common', 'uptime_down_islands'))
+        except:
+            self.uptime_down_islands = 0
+        try:
+            self.uptime_workers = int(self.config.get('common', 'uptime_workers'))
+        except:
+            self.uptime_workers = 1
+        try:
+            self.uptime_interval_profiles = int(self.config.get('common', 'uptime_interval_profiles'))
+        except:
+            self.uptime_interval_profiles = 0
+        try:
+            self.uptime_interval_profile_age = int(self.config.get('common', 'uptime_interval_profile_age'))
+        except:
+            self.uptime_interval_profile_age = 7
+        try:
+            self.uptime_result_cache = int(self.config.get('common', 'uptime_result_cache'))
+        except:
+            self.uptime_result_cache = 0
+        try:
+            self.uptime_result_cache_horizon = int(self.config.get('common', 'uptime_result_cache_horizon'))
+        except:
+            self.uptime_result_cache_horizon = 24
+        try:
+            self.graph_max_requests = int(self.config.get('common', 'graph_max_requests'))
+        except:
+            self.graph_max_requests = 4
+        try:
+            self.graph_cache_dir = self.config.get('common', 'graph_cache_dir')
+        except:
+            self.graph_cache_dir = ''
+        try:
+            self.graph_cache_max_size = int(self.config.get('common', 'graph_cache_max_size'))
+        except:
+            self.graph_cache_max_size = 1024
+        try:
+            self.graph_cache_max_age = int(self.config.get('common', 'graph_cache_max_age'))
+        except:
+            self.graph_cache_max_age = 90
+        # SLA calendars: <name>=<days> <HH:MM>-<HH:MM> [timezone] and optional <name>_holidays=<dd-mm-yyyy>,...
+        if self.config.has_section('sla_calendars'):
+            options = dict(self.config.items('sla_calendars'))
+            for name, definition in options.items():
+                if not name.endswith('_holidays'):
+                    self.sla_calendars[name] = (definition, options.get(name + '_holidays', ''))
         # Parse e-mail stuff (also common)
         try:
             self.email_sender = self.config.get('email', 'sender')
@@ -224,6 +331,10 @@ class Config:
             self.report_graph_width = self.customer_config.get('report', 'graph_width')
         except:
             self.report_graph_width = '1200'
+        try:
+            self.report_graph_renderer = self.customer_config.get('report', 'graph_renderer')
+        except:
+            self.report_graph_renderer = 'frontend'
         try:
             self.report_title = self.customer_config.get('report', 'title')
         except:
@@ -236,6 +347,22 @@ class Config:
             self.report_infra_picture = self.customer_config.get('report', 'infra_picture')
         except:
             self.report_infra_picture = None
+        try:
+            self.uptime_source = self.customer_config.get('report', 'uptime_source')
+        except:
+            self.uptime_source = 'history'
+        try:
+            self.uptime_windows = [window.strip() for window in self.customer_config.get('report', 'uptime_windows').split(',') if window.strip()]
+        except:
+            self.uptime_windows = []
+        try:
+            self.sla_calendar = self.customer_config.get('report', 'sla_calendar')
+        except:
+            self.sla_calendar = None
+        try:
+            self.uptime_heatmap = self.customer_config.get('report', 'uptime_heatmap')
+        except:
+            self.uptime_heatmap = ''
         try:
             self.custom_section = int(self.customer_config.get('report', 'custom'))
         except:
@@ -255,8 +382,10 @@ class Config:
             self.table_first_column_color = config.table_first_column_color
 
 class Postgres(object):
-    def __init__(self, instances):
+    def __init__(self, instances, itersize=10000):
         self.postgres_support = 0
+        self.itersize = itersize
+        self.stream_seq = 0
         self.connections = []
         self.cursor = []
         self.version = []
@@ -327,6 +456,8 @@ class Postgres(object):
             except Exception as e:
                 self.logger.error("PG: Failed to execute query: %s" % query)
                 self.logger.error("PG: Additional info: %s" % e)
+                # A failed query aborts the transaction. Roll it back, otherwise all following queries fail as well
+                self.rollback(db)
                 return -1
 
             try:
@@ -343,6 +474,300 @@ class Postgres(object):
             self.logger.critical("Error in Postgres connection DB: %s" % db)
             return -2
 
+    def stream(self, db, query, itersize=None):
+        # Generator which yields the rows of a query. A server side (named) cursor is used, which fetches the rows
+        # in batches of itersize, so big results (like a month of history) are never in memory all at once
+        if self.postgres_support == 0:
+            self.logger.error("Postgres not supported")
+            return
+        if not db in self.dbs:
+            return
+        indx = self.dbs.index(db)
+        self.stream_seq += 1
+        cursor = self.connections[indx].cursor('mios_stream_%s' % self.stream_seq, cursor_factory=self.psycopg2_extras.DictCursor)
+        if itersize:
+            cursor.itersize = itersize
+        else:
+            cursor.itersize = self.itersize
+        try:
+            try:
+                cursor.execute(query)
+            except Exception as e:
+                self.logger.error("PG: Failed to execute query: %s" % query)
+                self.logger.error("PG: Additional info: %s" % e)
+                raise
+            self.logger.debug("Query streamed: %s" % query)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+    def commit(self, db):
+        if not db in self.dbs:
+            return -1
+        try:
+            indx = self.dbs.index(db)
+            self.connections[indx].commit()
+        except Exception as e:
+            self.logger.error("PG: Failed to commit DB: %s" % db)
+            self.logger.error("PG: Additional info: %s" % e)
+            return -1
+
+    def rollback(self, db):
+        if not db in self.dbs:
+            return -1
+        try:
+            indx = self.dbs.index(db)
+            self.connections[indx].rollback()
+        except Exception as e:
+            self.logger.error("PG: Failed to rollback DB: %s" % db)
+            self.logger.error("PG: Additional info: %s" % e)
+            return -1
+
+class PostgresPool(object):
+    # Gives every thread its own Postgres object (and so its own connections). Used when the uptime is calculated
+    # by multiple worker threads. All attributes are looked up on the Postgres object of the calling thread
+    def __init__(self, instances, itersize=10000):
+        self.instances = instances
+        self.itersize = itersize
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        if not hasattr(self.local, 'postgres'):
+            self.local.postgres = Postgres(self.instances, self.itersize)
+        return getattr(self.local.postgres, name)
+
+class MaintenanceCache(object):
+    # Maintenance windows which overlap with a period. They are loaded once per group and indexed by groupid and hostid,
+    # so the summary table and the uptime calculation of every item can use them without querying the database again.
+    # Recurring time periods are expanded (see expand_timeperiod) into the occurrences within the period once per
+    # maintenance, so windows holds the occurrences per maintenanceid
+    def __init__(self, start_epoch, end_epoch):
+        self.start_epoch = start_epoch
+        self.end_epoch = end_epoch
+        self.windows = {}
+        self.windows_by_groupid = {}
+        self.timeperiodids = set()
+        self.groupids_by_hostid = {}
+        # The cache can be shared by the uptime worker threads
+        self.lock = threading.RLock()
+        self.logger = logging.getLogger(type(self).__name__)
+
+    def covers(self, start_epoch, end_epoch):
+        return self.start_epoch <= start_epoch and end_epoch <= self.end_epoch
+
+    def load_hostgroup(self, hostgroupid):
+        # Load the windows of all hosts in the hostgroup (and of all other groups these hosts are member of)
+        rows = postgres.execute(config.postgres_dbname, "select hostid from hosts_groups where groupid = %s" % hostgroupid)
+        self.load_hosts([row[0] for row in rows])
+        self.load_groups([hostgroupid])
+
+    def load_hosts(self, hostids):
+        with self.lock:
+            hostids = list(set([int(hostid) for hostid in hostids if int(hostid) not in self.groupids_by_hostid]))
+            if len(hostids) == 0:
+                return
+            self.logger.info("Fetching groups for hosts: %s" % hostids)
+            groupids_by_hostid = dict((hostid, []) for hostid in hostids)
+            rows = postgres.execute(config.postgres_dbname, "select hostid, groupid from hosts_groups where hostid = any(%s)" % itemids_array(hostids))
+            for row in rows:
+                groupids_by_hostid[int(row[0])].append(int(row[1]))
+            self.load_groups([groupid for hostid in hostids for groupid in groupids_by_hostid[hostid]])
+            self.groupids_by_hostid.update(groupids_by_hostid)
+
+    def load_groups(self, groupids):
+        with self.lock:
+            self._load_groups(groupids)
+
+    def _load_groups(self, groupids):
+        groupids = list(set([int(groupid) for groupid in groupids if int(groupid) not in self.windows_by_groupid]))
+        if len(groupids) == 0:
+            return
+        self.logger.info("Fetching maintenance windows for groups: %s, epoch between %s and %s" % (groupids, self.start_epoch, self.end_epoch))
+        for groupid in groupids:
+            self.windows_by_groupid[groupid] = set()
+        # One time periods (timeperiod_type 0) must overlap with the period. Recurring periods (daily, weekly and
+        # monthly) only have a start_date in old Zabbix versions, so they are selected on the active period of the maintenance
+        rows = postgres.execute(config.postgres_dbname, "select maintenances_groups.groupid, maintenances.maintenanceid, timeperiods.timeperiodid, maintenances.name || '. ' || maintenances.description,\
+         timeperiod_type, every, month, dayofweek, day, start_time, period, start_date, active_since, active_till from timeperiods\
+         inner join maintenances_windows on maintenances_windows.timeperiodid = timeperiods.timeperiodid\
+         inner join maintenances on maintenances.maintenanceid = maintenances_windows.maintenanceid\
+         inner join maintenances_groups on maintenances_groups.maintenanceid = maintenances.maintenanceid\
+         where maintenances_groups.groupid = any(%s) and\
+         ((timeperiods.timeperiod_type = 0 and timeperiods.start_date <= %s and (timeperiods.start_date + timeperiods.period) >= %s) or\
+          (timeperiods.timeperiod_type <> 0 and maintenances.active_since <= %s and maintenances.active_till >= %s))\
+         order by start_date" % (itemids_array(groupids), self.end_epoch, self.start_epoch, self.end_epoch, self.start_epoch))
+        for row in rows:
+            maintenanceid = int(row[1])
+            timeperiodid = int(row[2])
+            # A maintenance can be linked to several groups. Its time periods are only expanded once
+            if timeperiodid not in self.timeperiodids:
+                self.timeperiodids.add(timeperiodid)
+                occurrences = expand_timeperiod(row[4], row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], row[13], self.start_epoch, self.end_epoch)
+                self.windows.setdefault(maintenanceid, []).extend([(row[3], start_window, end_window) for start_window, end_window in occurrences])
+                self.windows[maintenanceid].sort(key=lambda window: window[1:])
+            self.windows_by_groupid[int(row[0])].add(maintenanceid)
+        self.logger.debug("Maintenance windows: %s" % self.windows)
+
+    def get_group_windows(self, groupid):
+        # Returns (description, start, end) of every window of the group
+        self.load_groups([groupid])
+        return sorted([window for maintenanceid in self.windows_by_groupid[int(groupid)] for window in self.windows.get(maintenanceid, [])], key=lambda window: window[1:])
+
+    def get_host_windows(self, hostid):
+        # Returns (start, end) of every window of the groups the host is member of
+        self.load_hosts([hostid])
+        maintenanceids = set()
+        for groupid in self.groupids_by_hostid[int(hostid)]:
+            maintenanceids.update(self.windows_by_groupid[groupid])
+        return sorted([window[1:] for maintenanceid in maintenanceids for window in self.windows.get(maintenanceid, [])])
+
+def expand_timeperiod(timeperiod_type, every, month, dayofweek, day, start_time, period, start_date, active_since, active_till, start_epoch, end_epoch):
+    # Returns the (start, end) occurrences of a Zabbix maintenance time period which overlap with the period:
+    #  - 0: one time, from start_date
+    #  - 2: daily, every <every> days counted from the day active_since falls in
+    #  - 3: weekly, on the days of dayofweek (bit 0 is monday) of every <every> weeks counted from the week of active_since
+    #  - 4: monthly, in the months of month (bit 0 is january) on day <day>, or when day is 0 on the days of dayofweek
+    #       in week <every> of the month (1 - 4, 5 is the last week)
+    # Recurring occurrences start at start_time (seconds after midnight, local time) and are cut off at the active
+    # period of the maintenance
+    if timeperiod_type == 0:
+        return [(start_date, start_date + period)]
+    every = max(every, 1)
+    first_day = datetime.date.fromtimestamp(max(active_since, start_epoch - period))
+    last_day = datetime.date.fromtimestamp(min(active_till, end_epoch))
+    since_day = datetime.date.fromtimestamp(active_since)
+    since_monday = since_day - datetime.timedelta(days=since_day.weekday())
+    occurrences = []
+    current_day = first_day
+    while current_day <= last_day:
+        if timeperiod_type == 2:
+            matches = (current_day - since_day).days % every == 0
+        elif timeperiod_type == 3:
+            matches = dayofweek & (1 << current_day.weekday()) and ((current_day - since_monday).days / 7) % every == 0
+        elif timeperiod_type == 4:
+            if not month & (1 << (current_day.month - 1)):
+                matches = False
+            elif day:
+                matches = current_day.day == day
+            elif every == 5:
+                matches = dayofweek & (1 << current_day.weekday()) and (current_day + datetime.timedelta(days=7)).month != current_day.month
+            else:
+                matches = dayofweek & (1 << current_day.weekday()) and (current_day.day - 1) / 7 + 1 == every
+        else:
+            matches = False
+        if matches:
+            start_window = max(int(time.mktime(current_day.timetuple())) + start_time, active_since)
+            end_window = min(int(time.mktime(current_day.timetuple())) + start_time + period, active_till)
+            if start_window < end_window and start_window <= end_epoch and end_window >= start_epoch:
+                occurrences.append((start_window, end_window))
+        current_day += datetime.timedelta(days=1)
+    return occurrences
+
+def get_maintenance_cache(start_epoch, end_epoch):
+    # Reuse the maintenance cache as long as it covers the requested period
+    global maintenance_cache
+    if maintenance_cache is None or not maintenance_cache.covers(start_epoch, end_epoch):
+        maintenance_cache = MaintenanceCache(start_epoch, end_epoch)
+    return maintenance_cache
+
+class ItemStates(object):
+    # The state of an item over a period as bitmaps with one bit per polling interval (bucket). Bit 0 is the first
+    # bucket after start_epoch. Every state (down, nodata, maintenance) is a python long used as packed bit array,
+    # so percentages, downtime periods and combining redundant items are bit operations which run in C
+    def __init__(self, start_epoch, end_epoch, interval):
+        self.start_epoch = start_epoch
+        self.end_epoch = end_epoch
+        self.interval = interval
+        self.buckets = max(1, (end_epoch - start_epoch + interval - 1) / interval)
+        self.all = (1 << self.buckets) - 1
+        self.down = 0
+        self.nodata = 0
+        self.maintenance = 0
+
+    def bucket(self, clock):
+        return min(max(clock - self.start_epoch, 0) / self.interval, self.buckets - 1)
+
+    def period_bits(self, start_period, end_period):
+        # Bits of all buckets which overlap with the period (end not included)
+        if end_period <= self.start_epoch or start_period >= self.end_epoch or end_period <= start_period:
+            return 0
+        first = self.bucket(start_period)
+        last = self.bucket(end_period - 1)
+        return ((1 << (last - first + 1)) - 1) << first
+
+    def add_down(self, clocks, item_interval=None):
+        # clocks can be any iterable (like a stream from Postgres.stream). The bits are collected in a buffer first,
+        # because or-ing a long for every clock would copy the whole bitmap every time. When the buckets are smaller
+        # then the interval of the item (states which are combined use the smallest interval) a down clock marks all
+        # buckets until the next polling of the item
+        buffer = bytearray('0' * self.buckets)
+        for clock in clocks:
+            first = self.bucket(clock)
+            if item_interval and item_interval > self.interval:
+                last = self.bucket(min(clock + item_interval, self.end_epoch) - 1)
+                buffer[first:last + 1] = '1' * (last - first + 1)
+            else:
+                buffer[first] = '1'
+        self.down |= int(str(buffer[::-1]), 2)
+
+    def add_nodata(self, periods):
+        for start_period, end_period in periods:
+            self.nodata |= self.period_bits(start_period, end_period)
+
+    def add_maintenance(self, windows):
+        # The end of a maintenance window is part of the window
+        for start_window, end_window in windows:
+            self.maintenance |= self.period_bits(start_window, end_window + 1)
+
+    def unavailable(self):
+        return self.down | self.nodata
+
+    def up(self):
+        return self.all & ~self.unavailable()
+
+    def periods(self, bits):
+        # Returns the (start, end) epochs of the consecutive runs of set bits
+        bit_string = bin(bits)[2:][::-1]
+        return [(self.start_epoch + match.start() * self.interval, min(self.start_epoch + match.end() * self.interval, self.end_epoch))
+                for match in re.finditer('1+', bit_string)]
+
+    def counters(self):
+        # Same tuple as get_uptime_counters, counted in buckets in stead of pollings. A bucket which is down and
+        # without data counts as down
+        not_in_maintenance = self.all & ~self.maintenance
+        nodata = self.nodata & ~self.down
+        return (self.buckets,
+                count_bits(self.down & not_in_maintenance),
+                count_bits(self.down & self.maintenance),
+                count_bits(nodata & not_in_maintenance),
+                count_bits(nodata & self.maintenance),
+                self.periods(self.unavailable()))
+
+def count_bits(bits):
+    return bin(bits).count('1')
+
+def combine_item_states(item_states, redundant=True):
+    # Combines the states of items which are measured with the same buckets into the state of the service they
+    # back. With redundant items the service is unavailable when all items are unavailable (and of the bitmaps),
+    # otherwise when any item is unavailable (or of the bitmaps). An unavailable bucket only counts as maintenance
+    # when all unavailable items are in maintenance. It counts as nodata when none of the items that make the
+    # service unavailable is down
+    first = item_states[0]
+    for states in item_states[1:]:
+        if (states.start_epoch, states.end_epoch, states.interval) != (first.start_epoch, first.end_epoch, first.interval):
+            raise ValueError('Only item states with the same period and interval can be combined')
+    combined = ItemStates(first.start_epoch, first.end_epoch, first.interval)
+    if redundant:
+        unavailable = reduce(lambda bits, states: bits & states.unavailable(), item_states, combined.all)
+        combined.down = unavailable & reduce(lambda bits, states: bits | states.down, item_states, 0)
+    else:
+        unavailable = reduce(lambda bits, states: bits | states.unavailable(), item_states, 0)
+        combined.down = reduce(lambda bits, states: bits | states.down, item_states, 0)
+    combined.nodata = unavailable & ~combined.down
+    combined.maintenance = unavailable & reduce(lambda bits, states: bits & (states.maintenance | (combined.all & ~states.unavailable())), item_states, combined.all)
+    return combined
+
 def my_logger(log_text, loglevel='info'):
     rootLogger = logging.getLogger()
     method_caller = sys._getframe().f_back.f_code.co_name
@@ -426,130 +851,1354 @@ def check_hostgroup_graphs(hostgroupid):
         result = 0
     return result
 
-def get_graph(graphid, graphtype):
-    import pycurl
-    import StringIO
-    curl = pycurl.Curl()
-    buffer = StringIO.StringIO()
-
-    z_server = config.zabbix_frontend
-    z_user = config.zabbix_user
-    z_password = config.zabbix_password
-    z_url_index = z_server + 'index.php'
-    z_url_graph = z_server + 'chart2.php'
-    z_login_data = 'name=' + z_user + '&password=' + z_password + '&autologon=1&enter=Sign+in'
-    # When we leave the filename of the cookie empty, curl stores the cookie in memory
-    # so now the cookie doesn't have to be removed after usage. When the script finishes, the cookie is also gone
-    z_filename_cookie = ''
-    z_image_name = mreport_home + '/' + str(graphid) + '_' + graphtype + '.png'
-    # Log on to Zabbix and get session cookie
-    my_logger('Logging on to Zabbix and retrieving cookie', 'debug')
-    curl.setopt(curl.URL, z_url_index)
-    curl.setopt(curl.POSTFIELDS, z_login_data)
-    curl.setopt(curl.COOKIEJAR, z_filename_cookie)
-    curl.setopt(curl.COOKIEFILE, z_filename_cookie)
-    curl.setopt(curl.SSL_VERIFYPEER, 0)
-    curl.perform()
-    # Retrieve graphs using cookie
+def get_graph_window(graphtype):
     # By just giving a period the graph will be generated from today and "period" seconds ago. So a period of 604800 will be 1 week (in seconds)
     # You can also give a starttime (&stime=yyyymmddhh24mm). Example: &stime=201310130000&period=86400, will start from 13-10-2013 and show 1 day (86400 seconds)
     if graphtype == 't':  # trending graph
-        my_logger('Fetching trending graph', 'info')
         day, month, year = config.report_trend_start.split('-')
-        stime = year + month + day + '000000'
-        my_logger("graphid: %s, width: %s, stime: %s, period: %s" % (str(graphid), config.report_graph_width, stime, str(config.report_trend_period)), 'info')
-        curl.setopt(curl.URL, z_url_graph + '?graphid=' + str(graphid) + '&width=' + config.report_graph_width + '&stime=' + stime + '&period=' + str(config.report_trend_period) + '&isNow=0')
+        period = config.report_trend_period
     else:  # normal graph
-        my_logger('Fetching normal graph', 'info')
         day, month, year = config.report_start_date.split('-')
-        stime = year + month + day + '000000'
-        my_logger("graphid: %s, width: %s, stime: %s, period: %s" % (str(graphid), config.report_graph_width, stime, str(config.report_period)), 'info')
-        curl.setopt(curl.URL, z_url_graph + '?graphid=' + str(graphid) + '&width=' + config.report_graph_width + '&stime=' + stime + '&period=' + str(config.report_period) + '&isNow=0')
-    curl.setopt(curl.WRITEFUNCTION, buffer.write)
-    curl.perform()
-    f = open(z_image_name, 'wb')
-    f.write(buffer.getvalue())
-    my_logger("Writing image: %s" % z_image_name, 'debug')
-    f.close()
+        period = config.report_period
+    return year + month + day + '000000', period
+
+class GraphCache(object):
+    # Cache of graph images on disk. The name of an image is the sha1 hash of its key (frontend url, graphid, stime,
+    # period and width), so the same graph is found again by every report which uses it
+    def __init__(self, directory, max_size, max_age):
+        self.directory = directory
+        self.max_size = max_size * 1024 * 1024
+        self.max_age = max_age * 86400
+        self.logger = logging.getLogger(type(self).__name__)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1('|'.join([str(part) for part in key])).hexdigest() + '.png')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+            image = f.read()
+            f.close()
+        except IOError:
+            return None
+        # Touch the image, so the images which are used are evicted last
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.logger.debug("Graph image found in cache: %s" % path)
+        return image
+
+    def put(self, key, image):
+        path = self.path(key)
+        # Write to a temporary file first, so reports which run at the same time never read a half written image
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        f = open(tmp_path, 'wb')
+        f.write(image)
+        f.close()
+        os.rename(tmp_path, path)
+
+    def evict(self):
+        # Removes the images which weren't used for max_age, then the least recently used images until the cache
+        # is smaller then max_size
+        now = time.time()
+        images = []
+        num_removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                if now - stat.st_mtime > self.max_age:
+                    os.remove(path)
+                    num_removed += 1
+                else:
+                    images.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                pass
+        images.sort()
+        cache_size = sum([size for mtime, size, path in images])
+        for mtime, size, path in images:
+            if cache_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                num_removed += 1
+            except OSError:
+                pass
+            cache_size -= size
+        self.logger.info("Graph cache: %s images removed, %.1f MB in use" % (num_removed, cache_size / 1048576.0))
+
+class GraphFetcher(object):
+    # Fetches graphs from the Zabbix frontend (chart2.php). It logs on once and keeps the session cookie and the
+    # connection (keep-alive) of one curl handle for all graphs. It logs on again only when the frontend answers with
+    # its login page in stead of an image (the session expired)
+    def __init__(self, frontend, user, password, cache=None):
+        import pycurl
+        self.pycurl = pycurl
+        self.frontend = frontend
+        self.user = user
+        self.password = password
+        self.curl = None
+        self.share = None
+        self.images = {}
+        self.cache = cache
+        self.logger = logging.getLogger(type(self).__name__)
+
+    def new_handle(self):
+        curl = self.pycurl.Curl()
+        # When we leave the filename of the cookie empty, curl stores the cookie in memory
+        # so now the cookie doesn't have to be removed after usage. When the script finishes, the cookie is also gone
+        curl.setopt(self.pycurl.COOKIEFILE, '')
+        curl.setopt(self.pycurl.SSL_VERIFYPEER, 0)
+        # All handles share the session cookie (and the dns cache) of the login
+        curl.setopt(self.pycurl.SHARE, self.share)
+        return curl
+
+    def connect(self):
+        self.share = self.pycurl.CurlShare()
+        self.share.setopt(self.pycurl.SH_SHARE, self.pycurl.LOCK_DATA_COOKIE)
+        self.share.setopt(self.pycurl.SH_SHARE, self.pycurl.LOCK_DATA_DNS)
+        self.curl = self.new_handle()
+        self.login()
+
+    def login(self):
+        import StringIO
+        # Log on to Zabbix and get session cookie
+        self.logger.debug('Logging on to Zabbix and retrieving cookie')
+        buffer = StringIO.StringIO()
+        self.curl.setopt(self.pycurl.URL, self.frontend + 'index.php')
+        self.curl.setopt(self.pycurl.POSTFIELDS, 'name=' + self.user + '&password=' + self.password + '&autologon=1&enter=Sign+in')
+        self.curl.setopt(self.pycurl.WRITEFUNCTION, buffer.write)
+        self.curl.perform()
+
+    def graph_url(self, graphid, graphtype):
+        stime, period = get_graph_window(graphtype)
+        return self.frontend + 'chart2.php?graphid=' + str(graphid) + '&width=' + config.report_graph_width + '&stime=' + stime + '&period=' + str(period) + '&isNow=0'
+
+    def cache_key(self, graphid, graphtype):
+        stime, period = get_graph_window(graphtype)
+        return (self.frontend, graphid, stime, period, config.report_graph_width)
+
+    def cached(self, graphid, graphtype):
+        if self.cache is None:
+            return None
+        return self.cache.get(self.cache_key(graphid, graphtype))
+
+    def store(self, graphid, graphtype, image):
+        # Only graphs of periods which have ended are stored, because those images never change
+        if self.cache is None or not image.startswith('\x89PNG'):
+            return
+        stime, period = get_graph_window(graphtype)
+        if time.mktime(time.strptime(stime, '%Y%m%d%H%M%S')) + int(period) < time.time():
+            self.cache.put(self.cache_key(graphid, graphtype), image)
+
+    def fetch(self, graphid, graphtype):
+        # Returns the PNG image of the graph. Graphs which were downloaded by prefetch are not requested again
+        import StringIO
+        url = self.graph_url(graphid, graphtype)
+        self.logger.info("Graph url: %s" % url)
+        if url in self.images:
+            return self.images.pop(url)
+        image = self.cached(graphid, graphtype)
+        if image is not None:
+            return image
+        if self.curl is None:
+            self.connect()
+        for attempt in range(2):
+            buffer = StringIO.StringIO()
+            self.curl.setopt(self.pycurl.HTTPGET, 1)
+            self.curl.setopt(self.pycurl.URL, url)
+            self.curl.setopt(self.pycurl.WRITEFUNCTION, buffer.write)
+            self.curl.perform()
+            image = buffer.getvalue()
+            if image.startswith('\x89PNG') or attempt == 1:
+                break
+            # Not an image, so the frontend sent its login page
+            self.logger.info('Zabbix session expired. Logging on again')
+            self.login()
+        if not image.startswith('\x89PNG'):
+            self.logger.error("Zabbix frontend didn't return an image for graph %s" % graphid)
+        self.store(graphid, graphtype, image)
+        return image
+
+    def prefetch(self, graphs, max_requests):
+        # Downloads the graphs [(graphid, graphtype), ...] concurrently with at most max_requests requests in flight.
+        # The handles are reused, so their connections are kept alive. Graphs for which the frontend sent its login page
+        # are fetched again by fetch, which logs on again. Graphs which are in the cache are left to fetch as well
+        import StringIO
+        pending = []
+        pending_urls = set(self.images)
+        for graphid, graphtype in graphs:
+            url = self.graph_url(graphid, graphtype)
+            if url not in pending_urls and (self.cache is None or not os.path.exists(self.cache.path(self.cache_key(graphid, graphtype)))):
+                pending_urls.add(url)
+                pending.append((graphid, graphtype, url))
+        if not pending:
+            return
+        pending.reverse()
+        if self.curl is None:
+            self.connect()
+        multi = self.pycurl.CurlMulti()
+        free_handles = [self.new_handle() for num in range(max(1, min(max_requests, len(pending))))]
+        all_handles = list(free_handles)
+        num_active = 0
+        expired = []
+        while pending or num_active:
+            while pending and free_handles:
+                curl = free_handles.pop()
+                curl.graphid, curl.graphtype, curl.url = pending.pop()
+                curl.buffer = StringIO.StringIO()
+                curl.setopt(self.pycurl.URL, curl.url)
+                curl.setopt(self.pycurl.WRITEFUNCTION, curl.buffer.write)
+                multi.add_handle(curl)
+                num_active += 1
+            while True:
+                ret, num_handles = multi.perform()
+                if ret != self.pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                num_queued, ok_list, err_list = multi.info_read()
+                for curl in ok_list:
+                    image = curl.buffer.getvalue()
+                    if image.startswith('\x89PNG'):
+                        self.images[curl.url] = image
+                        self.store(curl.graphid, curl.graphtype, image)
+                    else:
+                        expired.append(curl.url)
+                for curl, errno, errmsg in err_list:
+                    self.logger.error("Fetching graph %s failed: %s" % (curl.graphid, errmsg))
+                for curl in ok_list + [err[0] for err in err_list]:
+                    multi.remove_handle(curl)
+                    free_handles.append(curl)
+                    num_active -= 1
+                if num_queued == 0:
+                    break
+            if num_active:
+                multi.select(1.0)
+        for curl in all_handles:
+            curl.close()
+        multi.close()
+        if expired:
+            self.logger.info('Zabbix session expired during prefetch of %s graphs' % len(expired))
+
+    def close(self):
+        if self.curl is not None:
+            self.curl.close()
+            self.curl = None
+        self.images = {}
+
+def get_graph_fetcher():
+    global graph_fetcher
+    if graph_fetcher is None:
+        graph_cache = None
+        if config.graph_cache_dir:
+            graph_cache = GraphCache(config.graph_cache_dir, config.graph_cache_max_size, config.graph_cache_max_age)
+            graph_cache.evict()
+        graph_fetcher = GraphFetcher(config.zabbix_frontend, config.zabbix_user, config.zabbix_password, graph_cache)
+    return graph_fetcher
+
+def prefetch_graphs(graphData):
+    # Collects all graphs of the report in the order in which generate_report uses them and downloads them concurrently,
+    # so building the document only has to read finished images
+    if config.report_graph_renderer == 'local':
+        if Image is not None:
+            return
+        my_logger('Module PIL is not installed. Fetching the graphs from the Zabbix frontend', 'warning')
+        config.report_graph_renderer = 'frontend'
+    graphs = []
+    if config.custom_section == 1:
+        graphs.extend([(record['graphid'], 'c') for record in graphData if record['graphtype'] == 'c'])
+    graphs.extend([(record['graphid'], 'w') for record in graphData if record['graphtype'] == 'w'])
+    graphs.extend([(record['graphid'], 'p') for record in graphData if record['graphtype'] == 'p' or record['graphtype'] == 'r'])
+    graphs.extend([(record['graphid'], 't') for record in graphData if record['graphtype'] == 't' or record['graphtype'] == 'r'])
+    if config.graph_max_requests > 1 and len(graphs) > 1:
+        my_logger("Prefetching %s graphs (%s at a time)" % (len(graphs), config.graph_max_requests), 'info')
+        get_graph_fetcher().prefetch(graphs, config.graph_max_requests)
+
+def get_graph(graphid, graphtype):
+    # Returns the PNG image of the graph, which is handed to docx.picture as it is
+    if config.report_graph_renderer == 'local' and Image is not None:
+        return render_graph(graphid, graphtype)
+    graph_fetcher = get_graph_fetcher()
+    if graphtype == 't':  # trending graph
+        my_logger('Fetching trending graph', 'info')
+    else:  # normal graph
+        my_logger('Fetching normal graph', 'info')
+    return graph_fetcher.fetch(graphid, graphtype)
+
+def get_graph_items(graphid):
+    # Returns the graph and its items (graphs_items) in the order of the legend
+    graph = postgres.execute(config.postgres_dbname, "select name, height from graphs where graphid = %s" % graphid)[0]
+    items = postgres.execute(config.postgres_dbname, "select graphs_items.itemid, graphs_items.color, graphs_items.drawtype, graphs_items.calc_fnc,\
+     items.name, items.key_, items.value_type, items.units, hosts.host from graphs_items\
+     inner join items on items.itemid = graphs_items.itemid\
+     inner join hosts on hosts.hostid = items.hostid\
+     where graphs_items.graphid = %s order by graphs_items.sortorder, graphs_items.gitemid" % graphid)
+    return (graph, items)
+
+def get_graph_data(items, start_epoch, period, width, trends):
+    # Returns the values of the items downsampled to one (min, avg, max) per pixel column: {itemid: {x: (min, avg, max)}}
+    # The database does the downsampling, so at most width rows per item are transferred. Only numeric items are drawn
+    end_epoch = start_epoch + period
+    tables = {}
+    for item in items:
+        value_type = int(item['value_type'])
+        if value_type == 0:  # numeric float
+            table = trends and 'trends' or 'history'
+        elif value_type == 3:  # numeric unsigned
+            table = trends and 'trends_uint' or 'history_uint'
+        else:
+            continue
+        tables.setdefault(table, []).append(int(item['itemid']))
+    graph_data = {}
+    for table, itemids in tables.items():
+        if trends:
+            values = 'min(value_min), sum(value_avg * num) / sum(num), max(value_max)'
+        else:
+            values = 'min(value), avg(value), max(value)'
+        my_logger("Fetching downsampled values from %s for items: %s" % (table, itemids), 'debug')
+        rows = postgres.execute(config.postgres_dbname, "select itemid, (clock - %s)::bigint * %s / %s as x, %s from %s\
+         where itemid = any(%s) and clock >= %s and clock < %s group by itemid, x order by itemid, x" % (start_epoch, width, period, values, table, itemids_array(itemids), start_epoch, end_epoch))
+        for row in rows:
+            graph_data.setdefault(int(row[0]), {})[int(row[1])] = (float(row[2]), float(row[3]), float(row[4]))
+    return graph_data
+
+def expand_item_name(name, key):
+    # Replaces the positional macros ($1 - $9) in the name of an item by the parameters of its key
+    params = []
+    if '[' in key and key.endswith(']'):
+        params = [param.strip().strip('"') for param in key[key.index('[') + 1:-1].split(',')]
+    def param(match):
+        num = int(match.group(1))
+        if num <= len(params):
+            return params[num - 1]
+        return match.group(0)
+    return re.sub(r'\$([1-9])', param, name)
+
+def format_value(value, units):
+    # Formats a value like the Zabbix frontend does (1.5 K, 20 MB). Bytes use a base of 1024
+    if units in ('B', 'Bps'):
+        base = 1024.0
+    else:
+        base = 1000.0
+    prefix = ''
+    for next_prefix in ['K', 'M', 'G', 'T']:
+        if abs(value) < base:
+            break
+        value /= base
+        prefix = next_prefix
+    return ('%.4g %s%s' % (value, prefix, units)).strip()
+
+def axis_step(value_range, num_steps):
+    # Rounds value_range / num_steps up to 1, 2 or 5 times a power of 10
+    step = value_range / float(num_steps)
+    magnitude = 10 ** math.floor(math.log10(step))
+    for multiplier in (1, 2, 5, 10):
+        if multiplier * magnitude >= step:
+            return multiplier * magnitude
+
+def render_graph(graphid, graphtype):
+    # Draws the graph from the history (the trends for a trending graph) in stead of fetching it from chart2.php.
+    # Every pixel column has the min, avg and max of its values. Like chart2.php, calc_fnc selects which of them is
+    # drawn (all draws the avg with the min-max range behind it). All items use the left y axis
+    stime, period = get_graph_window(graphtype)
+    start_epoch = int(time.mktime(time.strptime(stime, '%Y%m%d%H%M%S')))
+    period = int(period)
+    width = int(config.report_graph_width)
+    graph, items = get_graph_items(graphid)
+    height = int(graph['height'])
+    my_logger("Rendering graph %s (%s) from %s" % (graphid, graph['name'], graphtype == 't' and 'trends' or 'history'), 'info')
+    graph_data = get_graph_data(items, start_epoch, period, width, graphtype == 't')
+
+    values = [value for points in graph_data.values() for point in points.values() for value in point]
+    if values:
+        y_min, y_max = min(0, min(values)), max(values)
+    else:
+        y_min, y_max = 0, 1
+    if y_max <= y_min:
+        y_max = y_min + 1
+    y_step = axis_step(y_max - y_min, 5)
+    y_min = y_step * math.floor(y_min / y_step)
+    y_max = y_min + y_step * math.ceil((y_max - y_min) / y_step)
+    # The values on the axis only get units when all items have the same units
+    units = ''
+    if len(set([item['units'] for item in items])) == 1:
+        units = items[0]['units']
+
+    margin_left, margin_right, margin_top, margin_bottom = 80, 20, 30, 40
+    image = Image.new('RGB', (margin_left + width + margin_right, margin_top + height + margin_bottom + 15 * len(items)), '#FFFFFF')
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+
+    def y_pixel(value):
+        return margin_top + height - int(round((value - y_min) * height / (y_max - y_min)))
+
+    title = "%s: %s" % (items and items[0]['host'] or '', graph['name'])
+    draw.text(((image.size[0] - draw.textsize(title, font=font)[0]) / 2, 8), title, fill='#000000', font=font)
+    # Horizontal grid with the values
+    for num in range(int(round((y_max - y_min) / y_step)) + 1):
+        value = y_min + num * y_step
+        draw.line([(margin_left, y_pixel(value)), (margin_left + width, y_pixel(value))], fill='#DDDDDD')
+        label = format_value(value, units)
+        draw.text((margin_left - 5 - draw.textsize(label, font=font)[0], y_pixel(value) - 5), label, fill='#000000', font=font)
+    # Vertical grid with the time. The smallest step which gives at most 12 lines
+    for x_step in (3600, 10800, 21600, 43200, 86400, 172800, 604800, 1209600, 2592000, 7776000):
+        if period / x_step <= 12:
+            break
+    for clock in range(start_epoch, start_epoch + period + 1, x_step):
+        x = margin_left + (clock - start_epoch) * width / period
+        draw.line([(x, margin_top), (x, margin_top + height)], fill='#DDDDDD')
+        if x_step < 86400:
+            label = time.strftime('%d-%m %H:%M', time.localtime(clock))
+        else:
+            label = time.strftime('%d-%m', time.localtime(clock))
+        draw.text((x - draw.textsize(label, font=font)[0] / 2, margin_top + height + 5), label, fill='#000000', font=font)
+    draw.rectangle([(margin_left, margin_top), (margin_left + width, margin_top + height)], outline='#888888')
+
+    legend_y = margin_top + height + margin_bottom - 15
+    for item in items:
+        color = '#' + item['color']
+        points = graph_data.get(int(item['itemid']), {})
+        x_values = sorted(points)
+        calc_fnc = int(item['calc_fnc'])  # 1 = min, 2 = avg, 4 = max, 7 = all
+        value_index = {1: 0, 4: 2}.get(calc_fnc, 1)
+        drawtype = int(item['drawtype'])  # 0 = line, 1 = filled region, 2 = bold line, 3 = dot, 4 = dashed line, 5 = gradient line
+        if calc_fnc == 7:
+            # Draw the min-max range in a lighter color behind the avg
+            red, green, blue = [int(item['color'][num:num + 2], 16) for num in (0, 2, 4)]
+            range_color = '#%02X%02X%02X' % (red + (255 - red) * 2 / 3, green + (255 - green) * 2 / 3, blue + (255 - blue) * 2 / 3)
+            for x in x_values:
+                draw.line([(margin_left + x, y_pixel(points[x][2])), (margin_left + x, y_pixel(points[x][0]))], fill=range_color)
+        # Lines are interrupted where the data has a gap of more then twice the usual distance between two values
+        if len(x_values) > 1:
+            distances = sorted([x_values[num] - x_values[num - 1] for num in range(1, len(x_values))])
+            max_distance = 2 * distances[len(distances) / 2]
+        else:
+            max_distance = 1
+        lines = []
+        prev_x = None
+        for x in x_values:
+            if prev_x is None or x - prev_x > max_distance:
+                lines.append([])
+            lines[-1].append((margin_left + x, y_pixel(points[x][value_index])))
+            prev_x = x
+        for line in lines:
+            if drawtype in (1, 5):
+                draw.polygon(line + [(line[-1][0], y_pixel(max(y_min, 0))), (line[0][0], y_pixel(max(y_min, 0)))], fill=color)
+            elif drawtype == 3:
+                draw.point(line, fill=color)
+            elif drawtype == 4:
+                for num in range(1, len(line), 2):
+                    draw.line([line[num - 1], line[num]], fill=color)
+            elif len(line) == 1:
+                draw.point(line, fill=color)
+            else:
+                draw.line(line, fill=color, width=drawtype == 2 and 2 or 1)
+        # Legend with the min, avg and max of the whole period
+        draw.rectangle([(margin_left, legend_y + 1), (margin_left + 8, legend_y + 9)], fill=color, outline='#000000')
+        draw.text((margin_left + 15, legend_y), "%s: %s" % (item['host'], expand_item_name(item['name'], item['key_'])), fill='#000000', font=font)
+        if points:
+            summary = "min: %s  avg: %s  max: %s" % (format_value(min([point[0] for point in points.values()]), item['units']),
+                                                     format_value(sum([point[1] for point in points.values()]) / len(points), item['units']),
+                                                     format_value(max([point[2] for point in points.values()]), item['units']))
+        else:
+            summary = 'no data'
+        draw.text((margin_left + width - draw.textsize(summary, font=font)[0], legend_y), summary, fill='#000000', font=font)
+        legend_y += 15
+
+    import StringIO
+    buffer = StringIO.StringIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
 
 def convert_interval(interval):
     #Converts an interval like 5m to 300 (seconds)
+    #Only the default interval of a flexible interval (1m;30s/1-5,09:00-18:00) is used. Returns None for user macros
     multiplier = 1
+    interval = str(interval).split(';')[0].strip()
     try:
         interval = int(interval)
     except ValueError:
-        interval_time = interval[-1]
-        interval = int(interval[:-1])
+        interval_time = interval[-1:]
+        try:
+            interval = int(interval[:-1])
+        except ValueError:
+            return None
         if interval_time == 'm':
             multiplier = 60
         elif interval_time == 'h':
             multiplier = 3600
+        elif interval_time == 'd':
+            multiplier = 86400
     return (interval * multiplier)
 
-def get_uptime_graph(itemid):
+def itemids_array(itemids):
+    # Converts a list of itemids to a postgres array which can be used with "itemid = any(...)"
+    return 'array[%s]::bigint[]' % ','.join([str(int(itemid)) for itemid in itemids])
+
+def get_uptime_graphs(itemids):
+    # Returns (downtime periods, percentage up, percentage down, percentage down in maintenance) of every item as a dict keyed by itemid
     my_logger('Fetching uptime graphs', 'info')
     day, month, year = map(int, config.report_start_date.split('-'))
 
     start_epoch = int(time.mktime((year, month, day, 0, 0, 0, 0, 0, 0)))
     end_epoch = start_epoch + config.report_period
-    my_logger("Fetching total polling items for item: %s, epoch between %s and %s" % (itemid, start_epoch, end_epoch), 'info')
-    polling_total = postgres.execute(config.postgres_dbname, "select count(*) from history_uint where itemid = %s and clock between %s and %s" % (itemid, start_epoch, end_epoch))[0][0]
-    my_logger("Total polling items for item: %s, %s" % (itemid, polling_total), 'debug')
-    my_logger("Fetching clocks for downtime, item: %s, epoch between %s and %s" % (itemid, start_epoch, end_epoch), 'info')
-    rows = postgres.execute(config.postgres_dbname, "select clock from history_uint where itemid = %s and clock > %s and clock < %s and value = 0 order by clock" % (itemid, start_epoch, end_epoch))
-    my_logger("Clocks for downtime for item: %s, %s" % (itemid, rows), 'debug')
-    polling_down_rows = []
+    itemids = [int(itemid) for itemid in itemids]
+    uptime_counters = get_period_uptime_counters(itemids, start_epoch, end_epoch)
+    if use_sla_calendar():
+        uptime_counters = apply_sla_calendar(uptime_counters, start_epoch, end_epoch)
+    uptime_graphs = {}
+    for itemid in itemids:
+        if itemid not in uptime_counters:
+            my_logger("Item %s not found in items table. Skipping" % itemid, 'warning')
+            uptime_graphs[itemid] = ([], 0, 0, 0)
+            continue
+        (polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_periods) = uptime_counters[itemid]
+        uptime_graphs[itemid] = summarize_uptime(itemid, start_epoch, end_epoch, polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_periods)
+    return uptime_graphs
+
+def get_window_starts(start_epoch, windows):
+    # Returns the start epochs of the windows (qtd: quarter to date, ytd: year to date) which end together with the
+    # report period. The quarter and year are the ones the report period starts in
+    report_start = datetime.datetime.fromtimestamp(start_epoch)
+    window_starts = []
+    for window in windows:
+        if window == 'qtd':
+            window_starts.append(int(time.mktime((report_start.year, (report_start.month - 1) / 3 * 3 + 1, 1, 0, 0, 0, 0, 0, -1))))
+        elif window == 'ytd':
+            window_starts.append(int(time.mktime((report_start.year, 1, 1, 0, 0, 0, 0, 0, -1))))
+        else:
+            my_logger("Unknown uptime window '%s'. Skipping" % window, 'warning')
+            window_starts.append(None)
+    return window_starts
+
+def get_uptime_windows(itemids, windows):
+    # Same as get_uptime_graphs, but also calculates the percentages of the windows (see get_window_starts) next to
+    # the report period. Returns the uptime graphs of the report period and a dict keyed by itemid with a list of
+    # (percentage_up, percentage_down, percentage_down_maintenance) for every window (None for unknown windows)
+    my_logger("Fetching uptime graphs with windows: %s" % windows, 'info')
+    day, month, year = map(int, config.report_start_date.split('-'))
+    start_epoch = int(time.mktime((year, month, day, 0, 0, 0, 0, 0, 0)))
+    end_epoch = start_epoch + config.report_period
+    itemids = [int(itemid) for itemid in itemids]
+    window_starts = get_window_starts(start_epoch, windows)
+    # The nested windows are calculated together, from the outer to the inner window. The report period is the inner one
+    nested_starts = sorted(set([window_start for window_start in window_starts if window_start is not None and window_start < start_epoch])) + [start_epoch]
+    if config.uptime_source == 'history' and not config.uptime_rollup and config.uptime_engine in ('python', 'numpy') and not config.uptime_down_islands and \
+            not (config.uptime_trends_threshold and end_epoch - nested_starts[0] > config.uptime_trends_threshold * 86400):
+        counters_function = lambda chunk, outer_start, end: get_uptime_counters_windows(chunk, nested_starts, end)
+        missing_itemids = itemids
+        window_counters = {}
+        if use_uptime_results(end_epoch):
+            # Items with cached results for all windows don't need the pass over the history
+            cached_counters = [read_uptime_results(itemids, window_start, end_epoch) for window_start in nested_starts]
+            missing_itemids = [itemid for itemid in itemids if not all([itemid in counters for counters in cached_counters])]
+            window_counters = dict((itemid, [counters[itemid] for counters in cached_counters]) for itemid in itemids if itemid not in missing_itemids)
+        if len(missing_itemids) > 0:
+            if config.uptime_workers > 1 and len(missing_itemids) > 1:
+                calculated_counters = get_uptime_counters_parallel(missing_itemids, nested_starts[0], end_epoch, counters_function)
+            else:
+                calculated_counters = counters_function(missing_itemids, nested_starts[0], end_epoch)
+            window_counters.update(calculated_counters)
+            if use_uptime_results(end_epoch):
+                for indx, window_start in enumerate(nested_starts):
+                    store_uptime_results(dict((itemid, counters[indx]) for itemid, counters in calculated_counters.items()), window_start, end_epoch)
+    else:
+        # The other engines and sources calculate every window on its own
+        window_counters = {}
+        for window_start in nested_starts:
+            for itemid, counters in get_period_uptime_counters(itemids, window_start, end_epoch).items():
+                window_counters.setdefault(itemid, []).append(counters)
+    uptime_graphs = {}
+    window_percentages = {}
+    for itemid in itemids:
+        if itemid not in window_counters:
+            my_logger("Item %s not found in items table. Skipping" % itemid, 'warning')
+            uptime_graphs[itemid] = ([], 0, 0, 0)
+            window_percentages[itemid] = [None if window_start is None else (0, 0, 0) for window_start in window_starts]
+            continue
+        counters_by_start = dict(zip(nested_starts, window_counters[itemid]))
+        if use_sla_calendar():
+            for window_start, counters in counters_by_start.items():
+                counters_by_start[window_start] = apply_sla_calendar({itemid: counters}, window_start, end_epoch)[itemid]
+        (polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_periods) = counters_by_start[start_epoch]
+        uptime_graphs[itemid] = summarize_uptime(itemid, start_epoch, end_epoch, polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_periods)
+        window_percentages[itemid] = []
+        for window_start in window_starts:
+            if window_start is None:
+                window_percentages[itemid].append(None)
+            else:
+                # A window which starts with (or after) the report period is the report period
+                window_percentages[itemid].append(uptime_percentages(*counters_by_start[min(window_start, start_epoch)][:5]))
+    return (uptime_graphs, window_percentages)
+
+def get_uptime_counters_windows(itemids, window_starts, end_epoch):
+    # Calculates the counters of get_uptime_counters for nested windows which all end at end_epoch (window_starts
+    # sorted, outer window first) with one scan of the history of the outer window. Returns a dict keyed by itemid
+    # with a list of counters for every window
+    if len(itemids) == 0:
+        return {}
+    items_array = itemids_array(itemids)
+    outer_start = window_starts[0]
+    my_logger("Fetching total polling items for items: %s, windows %s until %s" % (itemids, window_starts, end_epoch), 'info')
+    polling_totals = dict((itemid, [0] * len(window_starts)) for itemid in itemids)
+    inner_totals = ''.join([', sum(case when clock >= %s then 1 else 0 end)' % window_start for window_start in window_starts[1:]])
+    rows = postgres.execute(config.postgres_dbname, "select itemid, count(*)%s from history_uint where itemid = any(%s) and clock between %s and %s group by itemid" % (inner_totals, items_array, outer_start, end_epoch))
     for row in rows:
-        polling_down_rows.append(row[0])
-    my_logger("Fetching maintenance periods for item: %s, epoch between %s and %s" % (itemid, start_epoch, end_epoch), 'info')
-    item_maintenance_rows = postgres.execute(config.postgres_dbname, "select start_date, (start_date + period) from timeperiods\
-     inner join maintenances_windows on maintenances_windows.timeperiodid = timeperiods.timeperiodid\
-     inner join maintenances on maintenances.maintenanceid = maintenances_windows.maintenanceid\
-     inner join maintenances_groups on maintenances_groups.maintenanceid = maintenances.maintenanceid\
-     inner join groups on maintenances_groups.groupid = groups.groupid\
-     inner join hosts_groups on hosts_groups.groupid = groups.groupid\
-     inner join hosts on hosts_groups.hostid = hosts.hostid\
-     inner join items on items.hostid = hosts.hostid\
-     where items.itemid = %s and timeperiods.start_date between %s and %s" % (itemid, start_epoch, end_epoch))
-    my_logger("Maintenance periods for item: %s, %s" % (itemid, item_maintenance_rows), 'debug')
-    polling_down_maintenance = []
-    polling_down = list(polling_down_rows)  # Make copy of list so that it can be edited without affecting original list (mutable), same as polling_down_rows[:]
-    my_logger('Check if downtime was in maintenance', 'info')
-    for clock in polling_down_rows:
-        for mclock in item_maintenance_rows:
-            if mclock[0] <= clock <= mclock[1]:
-                # Is down clock between maintenance period?
-                # Then add to down_maintenance and remove from down
-                polling_down_maintenance.append(clock)
-                polling_down.remove(clock)
-
-    my_logger("Fetch item interval for item: %s" % itemid, 'info')
-    item_interval = postgres.execute(config.postgres_dbname, "select delay from items where itemid = %s" % itemid)[0][0]
-    my_logger("Item interval for item: %s, %s" % (itemid, item_interval), 'debug')
-    item_interval = convert_interval(item_interval)
+        polling_totals[int(row[0])] = [int(total) for total in row[1:]]
+    item_intervals, item_hostids = get_items_info(itemids)
+    item_maintenance_rows = get_items_maintenance(item_hostids, outer_start, end_epoch)
+    item_nodata_rows = get_items_nodata(itemids, outer_start, end_epoch, item_intervals)
+
+    def item_window_counters(itemid, polling_down_clocks):
+        windows = count_uptime_windows(polling_down_clocks, window_starts, end_epoch, merge_maintenance_windows(item_maintenance_rows[itemid]), item_intervals[itemid], item_nodata_rows[itemid])
+        return [(polling_totals[itemid][indx], num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, merge_downtime_periods(downtime_runs, intersect_intervals(item_nodata_rows[itemid], [(window_starts[indx], end_epoch + 1)])))
+                for indx, (num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_runs) in enumerate(windows)]
+
+    my_logger("Fetching clocks for downtime, items: %s, epoch between %s and %s" % (itemids, outer_start, end_epoch), 'info')
+    window_counters = {}
+    rows = postgres.stream(config.postgres_dbname, "select itemid, clock from history_uint where itemid = any(%s) and clock between %s and %s and value = 0 order by itemid, clock" % (items_array, outer_start, end_epoch))
+    for itemid, item_rows in itertools.groupby(rows, key=lambda row: int(row[0])):
+        if itemid in item_intervals:
+            window_counters[itemid] = item_window_counters(itemid, (row[1] for row in item_rows))
+    for itemid in itemids:
+        if itemid in item_intervals and itemid not in window_counters:
+            window_counters[itemid] = item_window_counters(itemid, [])
+    return window_counters
+
+def get_period_uptime_counters(itemids, start_epoch, end_epoch):
+    # Returns the uptime counters of the items (see get_uptime_counters). The counters of closed periods come from
+    # the result cache when it is configured
+    if use_uptime_results(end_epoch):
+        uptime_counters = read_uptime_results(itemids, start_epoch, end_epoch)
+        missing_itemids = [itemid for itemid in itemids if itemid not in uptime_counters]
+        if len(missing_itemids) > 0:
+            calculated_counters = calculate_period_uptime_counters(missing_itemids, start_epoch, end_epoch)
+            store_uptime_results(calculated_counters, start_epoch, end_epoch)
+            uptime_counters.update(calculated_counters)
+        return uptime_counters
+    return calculate_period_uptime_counters(itemids, start_epoch, end_epoch)
+
+def use_uptime_results(end_epoch):
+    # Only periods which ended before the safety horizon are cached. Later periods can still get (late) history
+    return config.uptime_result_cache and end_epoch < int(time.time()) - config.uptime_result_cache_horizon * 3600
+
+def get_engine_version():
+    # Results are only reused when they are calculated by the same version with the same settings
+    return '%s %s %s trends=%s islands=%s profiles=%s rollup=%s' % (__version__, config.uptime_engine, config.uptime_source, config.uptime_trends_threshold,
+                                                                   config.uptime_down_islands, config.uptime_interval_profiles, config.uptime_rollup)
+
+def read_uptime_results(itemids, start_epoch, end_epoch):
+    # Returns the cached counters (see get_uptime_counters) of the items from mios_uptime_results
+    # (sql/08_uptime_results.sql). Returns nothing when a recompute is forced (--recompute)
+    if config.uptime_recompute or len(itemids) == 0:
+        return {}
+    my_logger("Fetching cached uptime for items: %s, epoch between %s and %s" % (itemids, start_epoch, end_epoch), 'info')
+    rows = postgres.execute(config.postgres_dbname, "select itemid, samples, down, down_in_maintenance, nodata_pollings, nodata_pollings_in_maintenance, downtime_starts, downtime_ends\
+     from mios_uptime_results where itemid = any(%s) and start_epoch = %s and end_epoch = %s and engine_version = '%s'" % (itemids_array(itemids), start_epoch, end_epoch, get_engine_version()))
+    uptime_counters = {}
+    for row in rows:
+        uptime_counters[int(row['itemid'])] = (row['samples'], row['down'], row['down_in_maintenance'], row['nodata_pollings'], row['nodata_pollings_in_maintenance'], zip(row['downtime_starts'], row['downtime_ends']))
+    my_logger("Cached uptime found for items: %s" % uptime_counters.keys(), 'debug')
+    return uptime_counters
+
+def store_uptime_results(uptime_counters, start_epoch, end_epoch):
+    # Stores the counters (and the percentages) of the items in mios_uptime_results. Old results of the items are replaced
+    if len(uptime_counters) == 0:
+        return
+    engine_version = get_engine_version()
+    my_logger("Storing uptime of items: %s, epoch between %s and %s" % (uptime_counters.keys(), start_epoch, end_epoch), 'info')
+    postgres.execute(config.postgres_dbname, "delete from mios_uptime_results where itemid = any(%s) and start_epoch = %s and end_epoch = %s and engine_version = '%s' returning itemid" %
+                     (itemids_array(uptime_counters.keys()), start_epoch, end_epoch, engine_version))
+    now = int(time.time())
+    for itemid, counters in uptime_counters.items():
+        (polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_periods) = counters
+        (percentage_up, percentage_down, percentage_down_maintenance) = uptime_percentages(*counters[:5])
+        downtime_starts = '{' + ','.join([str(period[0]) for period in downtime_periods]) + '}'
+        downtime_ends = '{' + ','.join([str(period[1]) for period in downtime_periods]) + '}'
+        postgres.execute(config.postgres_dbname, "insert into mios_uptime_results (itemid, start_epoch, end_epoch, engine_version, samples, down, down_in_maintenance, nodata_pollings, nodata_pollings_in_maintenance,\
+         percentage_up, percentage_down, percentage_down_maintenance, downtime_starts, downtime_ends, calculated_at)\
+         values (%s, %s, %s, '%s', %s, %s, %s, %s, %s, %s, %s, %s, '%s', '%s', %s) returning itemid" % (itemid, start_epoch, end_epoch, engine_version, polling_total, num_pollings_down, num_pollings_down_maintenance,
+                                                                                                   num_pollings_nodata, num_pollings_nodata_maintenance, percentage_up, percentage_down, percentage_down_maintenance, downtime_starts, downtime_ends, now))
+    postgres.commit(config.postgres_dbname)
+
+def calculate_period_uptime_counters(itemids, start_epoch, end_epoch):
+    # Calculates the uptime counters of the items from the daily rollup and/or with the worker pool when they are configured
+    if config.uptime_rollup and config.uptime_source == 'history':
+        counters_function = get_uptime_counters_rollup
+    else:
+        counters_function = get_uptime_counters
+    if config.uptime_workers > 1 and len(itemids) > 1:
+        return get_uptime_counters_parallel(itemids, start_epoch, end_epoch, counters_function)
+    return counters_function(itemids, start_epoch, end_epoch)
+
+def get_service_uptimes(servicesList):
+    # Calculates the combined uptime of business services which are backed by several items (mios_report_services).
+    # The counters of all member items are fetched at once. Returns a list of (servicename, (downtime_periods,
+    # percentage_up, percentage_down, percentage_down_maintenance)) in the order of servicesList
+    my_logger('Fetching uptime of business services', 'info')
+    day, month, year = map(int, config.report_start_date.split('-'))
+    start_epoch = int(time.mktime((year, month, day, 0, 0, 0, 0, 0, 0)))
+    end_epoch = start_epoch + config.report_period
+    services = []
+    for serviceid, service_rows in itertools.groupby(servicesList, key=lambda record: int(record['serviceid'])):
+        service_rows = list(service_rows)
+        services.append((service_rows[0]['servicename'], service_rows[0]['operator'], [int(record['itemid']) for record in service_rows]))
+    itemids = list(set([itemid for service in services for itemid in service[2]]))
+    if len(itemids) == 0:
+        return []
+    # With an SLA calendar only the downtime of the members within the calendar counts
+    service_seconds = end_epoch - start_epoch
+    calendar_windows = None
+    if use_sla_calendar():
+        calendar_windows = get_sla_calendar(config.sla_calendar, start_epoch, end_epoch)
+        service_seconds = sum([end_window - start_window for start_window, end_window in calendar_windows])
+    if config.uptime_engine == 'bitmap':
+        # The states of all members are built with the same buckets (the smallest interval of the members), so the
+        # state of a service is a combination of the bitmaps of its members
+        item_intervals, item_hostids = get_items_info(itemids)
+        item_states = get_item_states(itemids, start_epoch, end_epoch, min(item_intervals.values() or [60]))
+        found_itemids = item_states
+    else:
+        uptime_counters = get_period_uptime_counters(itemids, start_epoch, end_epoch)
+        item_intervals, item_hostids = get_items_info(itemids)
+        item_maintenance_rows = get_items_maintenance(item_hostids, start_epoch, end_epoch)
+        if calendar_windows is not None:
+            for itemid, counters in uptime_counters.items():
+                uptime_counters[itemid] = counters[:5] + (intersect_intervals(counters[5], calendar_windows),)
+        found_itemids = uptime_counters
+    service_uptimes = []
+    for servicename, operator, service_itemids in services:
+        member_itemids = [itemid for itemid in service_itemids if itemid in found_itemids]
+        if len(member_itemids) < len(service_itemids):
+            my_logger("Items %s of service '%s' not found in items table. Skipping them" % (list(set(service_itemids) - set(member_itemids)), servicename), 'warning')
+        if len(member_itemids) == 0:
+            service_uptimes.append((servicename, ([], 0, 0, 0)))
+            continue
+        if config.uptime_engine == 'bitmap':
+            (downtime_periods, seconds_down, seconds_down_maintenance) = calculate_service_uptime_bitmap([item_states[itemid] for itemid in member_itemids], operator == 'or', calendar_windows)
+        else:
+            (downtime_periods, seconds_down, seconds_down_maintenance) = calculate_service_uptime(start_epoch, end_epoch,
+                                                                                                  [uptime_counters[itemid][5] for itemid in member_itemids],
+                                                                                                  [merge_maintenance_windows(item_maintenance_rows.get(itemid, [])) for itemid in member_itemids],
+                                                                                                  operator == 'or')
+        percentage_down = float(seconds_down) / service_seconds * 100 if service_seconds else 0
+        percentage_down_maintenance = float(seconds_down_maintenance) / service_seconds * 100 if service_seconds else 0
+        percentage_up = 100 - (percentage_down + percentage_down_maintenance)
+        my_logger("Service '%s' (%s of items %s) down: %s%%, down in maintenance: %s%%" % (servicename, operator, member_itemids, percentage_down, percentage_down_maintenance), 'info')
+        service_uptimes.append((servicename, (downtime_periods, percentage_up, percentage_down, percentage_down_maintenance)))
+    return service_uptimes
+
+def calculate_service_uptime(start_epoch, end_epoch, member_downtime_periods, member_maintenance_windows, redundant):
+    # Combines the downtime of the member items of a service in one time ordered pass. The downtime periods and the
+    # (merged) maintenance windows of every member are turned into sorted streams of state changes, which are merged
+    # with a k-way merge. Between two changes the state of the service is constant:
+    #  - redundant (or): the service is down when all members are down, otherwise when any member is down
+    #  - the downtime counts as maintenance when all members which are down are in maintenance
+    # Returns the downtime periods of the service and the seconds down and down in maintenance
+    def state_changes(periods, member, state):
+        for start_period, end_period in periods:
+            yield (start_period, 1, member, state)
+            yield (end_period, -1, member, state)
+
+    num_members = len(member_downtime_periods)
+    streams = []
+    for member in range(num_members):
+        streams.append(state_changes(member_downtime_periods[member], member, 'down'))
+        # The end of a maintenance window is part of the window
+        streams.append(state_changes([(start_window, end_window + 1) for start_window, end_window in member_maintenance_windows[member]], member, 'maintenance'))
+    down = [0] * num_members
+    maintenance = [0] * num_members
+    num_down = 0
+    num_down_not_maintenance = 0
+    downtime_periods = []
+    seconds_down = 0
+    seconds_down_maintenance = 0
+    prev_clock = start_epoch
+    for clock, change, member, state in itertools.chain(heapq.merge(*streams), [(end_epoch, 0, None, None)]):
+        clock = min(max(clock, start_epoch), end_epoch)
+        if clock > prev_clock and ((redundant and num_down == num_members) or (not redundant and num_down > 0)):
+            if num_down_not_maintenance == 0:
+                seconds_down_maintenance += clock - prev_clock
+            else:
+                seconds_down += clock - prev_clock
+            if downtime_periods and downtime_periods[-1][1] == prev_clock:
+                downtime_periods[-1] = (downtime_periods[-1][0], clock)
+            else:
+                downtime_periods.append((prev_clock, clock))
+        prev_clock = clock
+        if state == 'down':
+            down[member] += change
+            num_down += change
+            if not maintenance[member]:
+                num_down_not_maintenance += change
+        elif state == 'maintenance':
+            maintenance[member] += change
+            if down[member]:
+                num_down_not_maintenance -= change
+    return (downtime_periods, seconds_down, seconds_down_maintenance)
+
+def calculate_service_uptime_bitmap(member_states, redundant, calendar_windows=None):
+    # calculate_service_uptime for uptime_engine bitmap: the ItemStates of the members are combined with
+    # combine_item_states. With calendar_windows only the buckets within the SLA calendar count.
+    # Returns the downtime periods of the service and the seconds down and down in maintenance
+    states = combine_item_states(member_states, redundant)
+    unavailable = states.unavailable()
+    if calendar_windows is not None:
+        unavailable &= reduce(lambda bits, window: bits | states.period_bits(window[0], window[1]), calendar_windows, 0)
+    seconds_down = sum([end_period - start_period for start_period, end_period in states.periods(unavailable & ~states.maintenance)])
+    seconds_down_maintenance = sum([end_period - start_period for start_period, end_period in states.periods(unavailable & states.maintenance)])
+    return (states.periods(unavailable), seconds_down, seconds_down_maintenance)
+
+def get_uptime_counters_parallel(itemids, start_epoch, end_epoch, counters_function):
+    # Splits the items in chunks which are calculated by a pool of uptime_workers threads. Every thread has its own
+    # database connection (see PostgresPool). The chunks are small, so a slow item doesn't keep the other workers idle
+    from multiprocessing.pool import ThreadPool
+    # Create the maintenance cache up front, so all workers share the same one
+    get_maintenance_cache(start_epoch, end_epoch)
+    chunk_size = max(1, len(itemids) / (config.uptime_workers * 4))
+    chunks = [itemids[indx:indx + chunk_size] for indx in range(0, len(itemids), chunk_size)]
+    my_logger("Calculating uptime of %s items in %s chunks with %s workers" % (len(itemids), len(chunks), config.uptime_workers), 'info')
+    pool = ThreadPool(config.uptime_workers)
+    try:
+        results = pool.map(lambda chunk: counters_function(chunk, start_epoch, end_epoch), chunks)
+    finally:
+        pool.close()
+        pool.join()
+    uptime_counters = {}
+    for result in results:
+        uptime_counters.update(result)
+    return uptime_counters
+
+def get_uptime_counters(itemids, start_epoch, end_epoch):
+    # All history needed for the items is fetched with a couple of "itemid = any(...)" queries in stead of five queries per item.
+    # Returns a dict keyed by itemid with the tuple (polling_total, num_pollings_down, num_pollings_down_maintenance,
+    # num_pollings_nodata, num_pollings_nodata_maintenance, downtime_periods). Items which don't exist are left out
+    if len(itemids) == 0:
+        return {}
+    if config.uptime_source == 'events':
+        return get_uptime_counters_events(itemids, start_epoch, end_epoch)
+    if config.uptime_trends_threshold and end_epoch - start_epoch > config.uptime_trends_threshold * 86400:
+        return get_uptime_counters_trends(itemids, start_epoch, end_epoch)
+    if config.uptime_engine == 'database':
+        return get_uptime_counters_database(itemids, start_epoch, end_epoch)
+    if config.uptime_engine == 'bitmap':
+        return dict((itemid, states.counters()) for itemid, states in get_item_states(itemids, start_epoch, end_epoch).items())
+    items_array = itemids_array(itemids)
+    if config.uptime_engine == 'numpy' and not numpy:
+        my_logger('Uptime engine numpy is configured, but module numpy is not installed. Falling back to python', 'warning')
+    my_logger("Fetching total polling items for items: %s, epoch between %s and %s" % (itemids, start_epoch, end_epoch), 'info')
+    polling_totals = dict.fromkeys(itemids, 0)
+    rows = postgres.execute(config.postgres_dbname, "select itemid, count(*) from history_uint where itemid = any(%s) and clock between %s and %s group by itemid" % (items_array, start_epoch, end_epoch))
+    for row in rows:
+        polling_totals[int(row[0])] = row[1]
+    my_logger("Total polling items for items: %s" % polling_totals, 'debug')
+    item_intervals, item_hostids = get_items_info(itemids)
+    item_maintenance_rows = get_items_maintenance(item_hostids, start_epoch, end_epoch)
+    item_nodata_rows = get_items_nodata(itemids, start_epoch, end_epoch, item_intervals)
+
+    if config.uptime_down_islands:
+        # Let the database group the down clocks, so only one row per outage is transferred
+        down_islands = get_down_islands(itemids, start_epoch, end_epoch, item_intervals, item_maintenance_rows)
+        uptime_counters = {}
+        for itemid in item_intervals:
+            (downtime_runs, num_pollings_down, num_pollings_down_maintenance) = down_islands[itemid]
+            (num_pollings_nodata, num_pollings_nodata_maintenance) = count_nodata_python(merge_maintenance_windows(item_maintenance_rows[itemid]), item_intervals[itemid], item_nodata_rows[itemid])
+            downtime_periods = merge_downtime_periods(downtime_runs, item_nodata_rows[itemid])
+            uptime_counters[itemid] = (polling_totals[itemid], num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_periods)
+        return uptime_counters
+    # The down clocks are by far the biggest result. They are streamed with a server side cursor and processed
+    # per item as they come in, so they never have to be in memory all at once
+    my_logger("Fetching clocks for downtime, items: %s, epoch between %s and %s" % (itemids, start_epoch, end_epoch), 'info')
+    uptime_counters = {}
+    rows = postgres.stream(config.postgres_dbname, "select itemid, clock from history_uint where itemid = any(%s) and clock between %s and %s and value = 0 order by itemid, clock" % (items_array, start_epoch, end_epoch))
+    for itemid, item_rows in itertools.groupby(rows, key=lambda row: int(row[0])):
+        if itemid in item_intervals:
+            polling_down_clocks = (row[1] for row in item_rows)
+            uptime_counters[itemid] = calculate_uptime(itemid, polling_totals[itemid], polling_down_clocks, item_maintenance_rows[itemid], item_intervals[itemid], item_nodata_rows[itemid])
+    for itemid in itemids:
+        if itemid in item_intervals and itemid not in uptime_counters:
+            uptime_counters[itemid] = calculate_uptime(itemid, polling_totals[itemid], [], item_maintenance_rows[itemid], item_intervals[itemid], item_nodata_rows[itemid])
+    return uptime_counters
+
+def get_item_states(itemids, start_epoch, end_epoch, interval=None):
+    # Builds the ItemStates of the items from the history. Every item uses its own interval, unless an interval is
+    # given (items which are combined with combine_item_states need the same buckets)
+    item_intervals, item_hostids = get_items_info(itemids)
+    item_maintenance_rows = get_items_maintenance(item_hostids, start_epoch, end_epoch)
+    item_nodata_rows = get_items_nodata(itemids, start_epoch, end_epoch, item_intervals)
+    item_states = {}
+    for itemid, item_interval in item_intervals.items():
+        item_states[itemid] = ItemStates(start_epoch, end_epoch, interval or item_interval)
+        item_states[itemid].add_maintenance(item_maintenance_rows[itemid])
+        item_states[itemid].add_nodata(item_nodata_rows[itemid])
+    my_logger("Fetching clocks for downtime, items: %s, epoch between %s and %s" % (itemids, start_epoch, end_epoch), 'info')
+    rows = postgres.stream(config.postgres_dbname, "select itemid, clock from history_uint where itemid = any(%s) and clock between %s and %s and value = 0 order by itemid, clock" % (itemids_array(itemids), start_epoch, end_epoch))
+    for itemid, item_rows in itertools.groupby(rows, key=lambda row: int(row[0])):
+        if itemid in item_states:
+            item_states[itemid].add_down((row[1] for row in item_rows), item_intervals[itemid])
+    return item_states
+
+def get_items_nodata(itemids, start_epoch, end_epoch, item_intervals):
     # Get history values which have no data for longer then the interval and at least a couple of seconde more then the interval
-    interval_threshold = item_interval + int(item_interval/2)
-    my_logger("Fetching clocks with consecutive downtime larger then threshold for item: %s" % itemid, 'info')
-    rows = postgres.execute(config.postgres_dbname, "select clock, difference from\
+    # Every item has its own threshold, so they are passed to the query as a values list. The last clock before and the
+    # first clock after the period are added, so gaps which cross the start or the end of the period are found as well.
+    # These gaps are cut off at the period (end_epoch is the last second of the period, so they end at end_epoch + 1).
+    # Returns a dict keyed by itemid with the sorted (start, end) periods without data
+    interval_thresholds = ','.join(['(%s, %s)' % (itemid, item_interval + int(item_interval/2)) for itemid, item_interval in item_intervals.items()])
+    item_nodata_rows = dict((itemid, []) for itemid in itemids)
+    if interval_thresholds:
+        items_array = itemids_array(itemids)
+        my_logger("Fetching clocks with consecutive downtime larger then threshold for items: %s" % itemids, 'info')
+        rows = postgres.execute(config.postgres_dbname, "select t.itemid, clock, difference from\
+         (\
+          select itemid, clock, clock - lag(clock) over (partition by itemid order by clock) as difference from\
+          (\
+           select itemid, clock from history_uint where itemid = any(%s) and clock between %s and %s\
+           union all\
+           select items.itemid, (select max(clock) from history_uint where history_uint.itemid = items.itemid and history_uint.clock < %s) from items where items.itemid = any(%s)\
+           union all\
+           select items.itemid, (select min(clock) from history_uint where history_uint.itemid = items.itemid and history_uint.clock > %s) from items where items.itemid = any(%s)\
+          ) clocks\
+          where clock is not null\
+         ) t\
+         inner join (values %s) as thresholds(itemid, threshold) on thresholds.itemid = t.itemid\
+         where difference > threshold and clock > %s and clock - difference <= %s\
+         order by t.itemid, clock" % (items_array, start_epoch, end_epoch, start_epoch, items_array, end_epoch, items_array, interval_thresholds, start_epoch, end_epoch))
+        for row in rows:
+            end_date_nodata = min(row[1], end_epoch + 1)
+            seconds_nodata = row[2]
+            start_date_nodata = max(row[1] - seconds_nodata, start_epoch)
+            item_nodata_rows[int(row[0])].append((start_date_nodata, end_date_nodata))
+        my_logger("Clocks with consecutive downtime for items: %s" % item_nodata_rows, 'debug')
+    return item_nodata_rows
+
+def get_down_islands(itemids, start_epoch, end_epoch, item_intervals, item_maintenance_rows):
+    # Groups the down clocks of the items in the database (gaps and islands). A new island starts when the previous
+    # down clock is more then twice the interval ago, the same as the grouping in count_uptime_python.
+    # Returns a dict keyed by itemid with (downtime_runs, num_pollings_down, num_pollings_down_maintenance)
+    items_array = itemids_array(itemids)
+    down_islands = dict((itemid, ([], 0, 0)) for itemid in item_intervals)
+    if len(item_intervals) == 0:
+        return down_islands
+    my_logger("Fetching down islands for items: %s, epoch between %s and %s" % (itemids, start_epoch, end_epoch), 'info')
+    interval_thresholds = ','.join(['(%s, %s)' % (itemid, item_interval * 2) for itemid, item_interval in item_intervals.items()])
+    rows = postgres.execute(config.postgres_dbname, "select itemid, min(clock), max(clock), count(*) from\
+     (\
+      select itemid, clock, sum(new_island) over (partition by itemid order by clock) as island from\
+      (\
+       select history_uint.itemid, history_uint.clock,\
+        case when history_uint.clock - lag(history_uint.clock) over (partition by history_uint.itemid order by history_uint.clock) <= thresholds.threshold then 0 else 1 end as new_island\
+       from history_uint\
+       inner join (values %s) as thresholds(itemid, threshold) on thresholds.itemid = history_uint.itemid\
+       where history_uint.itemid = any(%s) and history_uint.clock between %s and %s and history_uint.value = 0\
+      ) t\
+     ) t\
+     group by itemid, island\
+     order by itemid, min(clock)" % (interval_thresholds, items_array, start_epoch, end_epoch))
+    downtime_runs = dict((itemid, []) for itemid in item_intervals)
+    num_pollings_down = dict.fromkeys(item_intervals, 0)
+    for row in rows:
+        itemid = int(row[0])
+        # Every down clock lasts one interval, the same as the periods of count_uptime_python
+        downtime_runs[itemid].append((row[1], row[2] + item_intervals[itemid]))
+        num_pollings_down[itemid] += row[3]
+    # The down clocks within maintenance are counted separately. The windows are merged, so no clock is counted twice
+    num_pollings_down_maintenance = dict.fromkeys(item_intervals, 0)
+    maintenance_windows = ','.join(['(%s, %s, %s)' % (itemid, window[0], window[1]) for itemid in item_intervals for window in merge_maintenance_windows(item_maintenance_rows[itemid])])
+    if maintenance_windows:
+        rows = postgres.execute(config.postgres_dbname, "select windows.itemid, count(*) from history_uint\
+         inner join (values %s) as windows(itemid, start_window, end_window) on windows.itemid = history_uint.itemid and history_uint.clock between windows.start_window and windows.end_window\
+         where history_uint.itemid = any(%s) and history_uint.clock between %s and %s and history_uint.value = 0\
+         group by windows.itemid" % (maintenance_windows, items_array, start_epoch, end_epoch))
+        for row in rows:
+            num_pollings_down_maintenance[int(row[0])] = row[1]
+    for itemid in item_intervals:
+        down_islands[itemid] = (downtime_runs[itemid], num_pollings_down[itemid] - num_pollings_down_maintenance[itemid], num_pollings_down_maintenance[itemid])
+    my_logger("Down islands for items: %s" % down_islands, 'debug')
+    return down_islands
+
+def get_items_info(itemids):
+    # Returns the interval (in seconds) and the hostid of the items. Every item is only looked up once per run.
+    # With uptime_interval_profiles the measured interval (see get_interval_profiles) is used in stead of items.delay
+    itemids = [int(itemid) for itemid in itemids]
+    missing_itemids = [itemid for itemid in itemids if itemid not in item_info_cache]
+    if len(missing_itemids) > 0:
+        my_logger("Fetch item interval for items: %s" % missing_itemids, 'info')
+        rows = postgres.execute(config.postgres_dbname, "select itemid, hostid, delay from items where itemid = any(%s)" % itemids_array(missing_itemids))
+        interval_profiles = {}
+        if config.uptime_interval_profiles and len(rows) > 0:
+            interval_profiles = get_interval_profiles([int(row[0]) for row in rows])
+        for row in rows:
+            itemid = int(row[0])
+            item_interval = interval_profiles.get(itemid) or convert_interval(row[2])
+            if not item_interval:
+                my_logger("Unknown interval '%s' for item %s. Using 60 seconds" % (row[2], itemid), 'warning')
+                item_interval = 60
+            item_info_cache[itemid] = (item_interval, int(row[1]))
+    item_intervals = dict((itemid, item_info_cache[itemid][0]) for itemid in itemids if itemid in item_info_cache)
+    item_hostids = dict((itemid, item_info_cache[itemid][1]) for itemid in itemids if itemid in item_info_cache)
+    my_logger("Item interval for items: %s" % item_intervals, 'debug')
+    return (item_intervals, item_hostids)
+
+def get_interval_profiles(itemids):
+    # Returns the measured polling interval of the items: the median time between two values in the last day of
+    # history. Unlike items.delay this also works for flexible intervals and user macros. The profiles are kept in
+    # mios_item_intervals (sql/07_interval_profiles.sql) and only measured again when they are older then
+    # uptime_interval_profile_age days. Items with too few values keep using items.delay
+    now = int(time.time())
+    interval_profiles = {}
+    rows = postgres.execute(config.postgres_dbname, "select itemid, item_interval from mios_item_intervals where itemid = any(%s) and profiled_at >= %s" % (itemids_array(itemids), now - config.uptime_interval_profile_age * 86400))
+    for row in rows:
+        interval_profiles[int(row[0])] = int(row[1])
+    missing_itemids = [itemid for itemid in itemids if itemid not in interval_profiles]
+    if len(missing_itemids) == 0:
+        return interval_profiles
+    my_logger("Measuring polling interval of items: %s" % missing_itemids, 'info')
+    rows = postgres.execute(config.postgres_dbname, "select itemid, percentile_disc(0.5) within group (order by difference), count(*) from\
      (\
-      select clock, clock - lag(clock) over (order by clock) as difference from history_uint\
-      where itemid = %s and clock between %s and %s\
+      select itemid, clock - lag(clock) over (partition by itemid order by clock) as difference from history_uint\
+      where itemid = any(%s) and clock >= %s\
      ) t\
-     where difference > %s" % (itemid, start_epoch, end_epoch, interval_threshold))
-    my_logger("Clocks with consecutive downtime for item: %s, %s" % (itemid, rows), 'debug')
-    item_nodata_rows = []
+     where difference > 0\
+     group by itemid" % (itemids_array(missing_itemids), now - 86400))
+    measured = dict((int(row[0]), (int(row[1]), int(row[2]))) for row in rows if row[2] >= 10)
+    if len(measured) > 0:
+        postgres.execute(config.postgres_dbname, "delete from mios_item_intervals where itemid = any(%s) returning itemid" % itemids_array(measured.keys()))
+        postgres.execute(config.postgres_dbname, "insert into mios_item_intervals (itemid, item_interval, samples, profiled_at) values %s returning itemid" %
+                         ','.join(['(%s, %s, %s, %s)' % (itemid, item_interval, samples, now) for itemid, (item_interval, samples) in measured.items()]))
+        postgres.commit(config.postgres_dbname)
+        for itemid, (item_interval, samples) in measured.items():
+            interval_profiles[itemid] = item_interval
+    my_logger("Measured polling interval of items: %s" % measured, 'debug')
+    return interval_profiles
+
+def get_items_maintenance(item_hostids, start_epoch, end_epoch):
+    # Returns the maintenance windows of the items from the maintenance cache
+    my_logger("Fetching maintenance periods for items: %s, epoch between %s and %s" % (item_hostids.keys(), start_epoch, end_epoch), 'info')
+    maintenance_cache = get_maintenance_cache(start_epoch, end_epoch)
+    maintenance_cache.load_hosts(item_hostids.values())
+    item_maintenance_rows = dict((itemid, maintenance_cache.get_host_windows(hostid)) for itemid, hostid in item_hostids.items())
+    my_logger("Maintenance periods for items: %s" % item_maintenance_rows, 'debug')
+    return item_maintenance_rows
+
+def get_uptime_counters_trends(itemids, start_epoch, end_epoch):
+    # Calculates the uptime from the hourly trends (trends_uint) in stead of the history. Used for long periods.
+    # Accuracy of the result:
+    #  - hours which are completely up (value_min > 0) or completely down (value_max = 0) are exact
+    #  - for an hour with up and down values of an item with only 0 and 1 values (value_max <= 1) the average is the
+    #    fraction of up pollings, so num * (1 - value_avg) pollings are down. This is exact as well
+    #  - for an hour with up and down values of other items only the minimum and maximum are known. Half of the
+    #    pollings of that hour are counted as down, so the error is at most num / 2 pollings per such hour
+    #  - maintenance and nodata are determined per whole hour, so they can be off by at most one hour at the
+    #    start and at the end of every maintenance window or nodata period
+    #  - only whole hours are used. When start_epoch is not at the start of an hour, the first partial hour is skipped
+    my_logger("Fetching trends for items: %s, epoch between %s and %s" % (itemids, start_epoch, end_epoch), 'info')
+    item_intervals, item_hostids = get_items_info(itemids)
+    item_maintenance_rows = get_items_maintenance(item_hostids, start_epoch, end_epoch)
+    first_hour = start_epoch + (3600 - start_epoch % 3600) % 3600
+    # The trends of an hour are written after the hour has ended
+    end_hours = min(end_epoch, int(time.time()) - 3600)
+    item_trends = dict((itemid, {}) for itemid in itemids)
+    rows = postgres.execute(config.postgres_dbname, "select itemid, clock, num, value_min, value_avg, value_max from trends_uint where itemid = any(%s) and clock >= %s and clock < %s" % (itemids_array(itemids), first_hour, end_hours))
+    for row in rows:
+        item_trends[int(row[0])][row[1]] = (row[2], row[3], row[4], row[5])
+
+    uptime_counters = {}
+    for itemid in itemids:
+        if itemid not in item_intervals:
+            continue
+        expected_pollings = max(3600 / item_intervals[itemid], 1)
+        hours = range(first_hour, end_hours, 3600)
+        hours_maintenance = set(classify_maintenance(hours, merge_maintenance_windows(item_maintenance_rows[itemid]))[0])
+        polling_total = 0
+        num_pollings_down = 0
+        num_pollings_down_maintenance = 0
+        num_pollings_nodata = 0
+        num_pollings_nodata_maintenance = 0
+        downtime_periods = []
+        for hour in hours:
+            (num, value_min, value_avg, value_max) = item_trends[itemid].get(hour, (0, None, None, None))
+            polling_total += num
+            if num == 0:
+                pollings_down = 0
+                downtime_periods.append((hour, min(hour + 3600, end_epoch)))
+            elif value_max == 0:
+                pollings_down = num
+                downtime_periods.append((hour, min(hour + 3600, end_epoch)))
+            elif value_min == 0:
+                if value_max <= 1:
+                    pollings_down = int(round(num * (1 - float(value_avg))))
+                else:
+                    pollings_down = num / 2
+                downtime_periods.append((hour, min(hour + 3600, end_epoch)))
+            else:
+                pollings_down = 0
+            # A difference of one polling is caused by the pollings not being aligned to the hour
+            pollings_nodata = expected_pollings - num
+            if pollings_nodata <= 1:
+                pollings_nodata = 0
+            if hour in hours_maintenance:
+                num_pollings_down_maintenance += pollings_down
+                num_pollings_nodata_maintenance += pollings_nodata
+            else:
+                num_pollings_down += pollings_down
+                num_pollings_nodata += pollings_nodata
+        downtime_periods = merge_downtime_periods(downtime_periods)
+        uptime_counters[itemid] = (polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_periods)
+    return uptime_counters
+
+def intersect_intervals(intervals, windows):
+    # Returns the parts of the intervals which fall within the windows. Both must be sorted and may not overlap
+    # (merge them first), so a single linear pass is enough
+    intersection = []
+    i = 0
+    j = 0
+    while i < len(intervals) and j < len(windows):
+        start_period = max(intervals[i][0], windows[j][0])
+        end_period = min(intervals[i][1], windows[j][1])
+        if start_period < end_period:
+            intersection.append((start_period, end_period))
+        if intervals[i][1] < windows[j][1]:
+            i += 1
+        else:
+            j += 1
+    return intersection
+
+def compile_sla_calendar(definition, holidays, start_epoch, end_epoch):
+    # Returns the sorted windows (start, end) of an SLA calendar within the period. definition is
+    # "<days> <HH:MM>-<HH:MM> [timezone]", like "mon-fri 07:00-19:00 Europe/Amsterdam". Days are a comma separated list
+    # of days and ranges of days (mon-fri,sun). holidays is a comma separated list of dates (dd-mm-yyyy) which are skipped
+    day_names = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+    fields = definition.split()
+    weekdays = set()
+    for days in fields[0].lower().split(','):
+        first_day, last_day = (days.split('-') + [days])[:2]
+        weekdays.update(range(day_names.index(first_day), day_names.index(last_day) + 1))
+    (start_hours, start_minutes), (end_hours, end_minutes) = [map(int, day_time.split(':')) for day_time in fields[1].split('-')]
+    holiday_dates = set([datetime.datetime.strptime(date.strip(), '%d-%m-%Y').date() for date in holidays.split(',') if date.strip()])
+    timezone = None
+    if len(fields) > 2:
+        if pytz:
+            timezone = pytz.timezone(fields[2])
+        else:
+            my_logger("SLA calendar uses timezone %s, but module pytz is not installed. Using local time" % fields[2], 'warning')
+    if timezone:
+        to_epoch = lambda local_time: calendar.timegm(timezone.localize(local_time).utctimetuple())
+        day = datetime.datetime.fromtimestamp(start_epoch, timezone).date()
+        last_day = datetime.datetime.fromtimestamp(end_epoch, timezone).date()
+    else:
+        to_epoch = lambda local_time: int(time.mktime(local_time.timetuple()))
+        day = datetime.date.fromtimestamp(start_epoch)
+        last_day = datetime.date.fromtimestamp(end_epoch)
+    windows = []
+    while day <= last_day:
+        if day.weekday() in weekdays and day not in holiday_dates:
+            midnight = datetime.datetime.combine(day, datetime.time())
+            start_window = max(to_epoch(midnight + datetime.timedelta(hours=start_hours, minutes=start_minutes)), start_epoch)
+            end_window = min(to_epoch(midnight + datetime.timedelta(hours=end_hours, minutes=end_minutes)), end_epoch)
+            if start_window < end_window:
+                windows.append((start_window, end_window))
+        day += datetime.timedelta(days=1)
+    return windows
+
+def get_sla_calendar(name, start_epoch, end_epoch):
+    # Returns the windows of the SLA calendar. A calendar is compiled once per period and shared by all items (and
+    # by all calendars with the same definition)
+    definition, holidays = config.sla_calendars[name]
+    key = (definition, holidays, start_epoch, end_epoch)
+    if key not in sla_calendar_cache:
+        my_logger("Compiling SLA calendar '%s' (%s), epoch between %s and %s" % (name, definition, start_epoch, end_epoch), 'info')
+        sla_calendar_cache[key] = compile_sla_calendar(definition, holidays, start_epoch, end_epoch)
+    return sla_calendar_cache[key]
+
+def use_sla_calendar():
+    if config.sla_calendar and config.sla_calendar not in config.sla_calendars:
+        my_logger("SLA calendar '%s' not found in section sla_calendars. Using the whole period" % config.sla_calendar, 'warning')
+        config.sla_calendar = None
+    return config.sla_calendar is not None
+
+def apply_sla_calendar(uptime_counters, start_epoch, end_epoch):
+    # Only the downtime within the SLA calendar counts. The downtime periods are intersected with the calendar (and
+    # the result with the maintenance windows) in linear passes, so the counters become seconds within the calendar:
+    # (calendar seconds, seconds down, seconds down in maintenance, 0, 0, downtime periods within the calendar)
+    calendar_windows = get_sla_calendar(config.sla_calendar, start_epoch, end_epoch)
+    calendar_seconds = sum([end_window - start_window for start_window, end_window in calendar_windows])
+    item_intervals, item_hostids = get_items_info(uptime_counters.keys())
+    item_maintenance_rows = get_items_maintenance(item_hostids, start_epoch, end_epoch)
+    calendar_counters = {}
+    for itemid, counters in uptime_counters.items():
+        downtime_periods = intersect_intervals(counters[5], calendar_windows)
+        # The end of a maintenance window is part of the window
+        maintenance_windows = [(start_window, end_window + 1) for start_window, end_window in merge_maintenance_windows(item_maintenance_rows.get(itemid, []))]
+        seconds_down = sum([end_period - start_period for start_period, end_period in downtime_periods])
+        seconds_down_maintenance = sum([end_period - start_period for start_period, end_period in intersect_intervals(downtime_periods, maintenance_windows)])
+        calendar_counters[itemid] = (calendar_seconds, seconds_down - seconds_down_maintenance, seconds_down_maintenance, 0, 0, downtime_periods)
+    return calendar_counters
+
+def get_uptime_counters_events(itemids, start_epoch, end_epoch):
+    # Derives the downtime from the problem events of the triggers on the items in stead of scanning every down
+    # polling in the history. An outage is only a couple of events. The counters are in seconds in stead of pollings
+    my_logger("Fetching problem events for items: %s, epoch between %s and %s" % (itemids, start_epoch, end_epoch), 'info')
+    item_intervals, item_hostids = get_items_info(itemids)
+    item_maintenance_rows = get_items_maintenance(item_hostids, start_epoch, end_epoch)
+    end_epoch = min(end_epoch, int(time.time()))
+    items_array = itemids_array(itemids)
+    trigger_events = {}
+    # The state of every trigger at the start of the period is the value of its last event before the period
+    rows = postgres.execute(config.postgres_dbname, "select distinct on (functions.itemid, events.objectid) functions.itemid, events.objectid, events.value from events\
+     inner join functions on functions.triggerid = events.objectid\
+     where events.source = 0 and events.object = 0 and functions.itemid = any(%s) and events.clock < %s\
+     order by functions.itemid, events.objectid, events.clock desc" % (items_array, start_epoch))
+    for row in rows:
+        trigger_events.setdefault((int(row[0]), int(row[1])), []).append((start_epoch, row[2]))
+    rows = postgres.execute(config.postgres_dbname, "select functions.itemid, events.objectid, events.clock, events.value from events\
+     inner join functions on functions.triggerid = events.objectid\
+     where events.source = 0 and events.object = 0 and functions.itemid = any(%s) and events.clock between %s and %s\
+     order by events.clock, events.eventid" % (items_array, start_epoch, end_epoch))
+    for row in rows:
+        trigger_events.setdefault((int(row[0]), int(row[1])), []).append((row[2], row[3]))
+    my_logger("Problem events for items: %s" % trigger_events, 'debug')
+
+    # Every trigger gives a sorted list of problem periods. They are merged per item
+    problem_periods = dict((itemid, []) for itemid in item_hostids)
+    for (itemid, triggerid), events in trigger_events.items():
+        if itemid not in problem_periods:
+            continue
+        trigger_problem_periods = []
+        start_problem = None
+        for clock, value in events:
+            if value == 1 and start_problem is None:
+                start_problem = clock
+            elif value == 0 and start_problem is not None:
+                trigger_problem_periods.append((start_problem, clock))
+                start_problem = None
+        if start_problem is not None:
+            trigger_problem_periods.append((start_problem, end_epoch))
+        problem_periods[itemid].append(trigger_problem_periods)
+
+    uptime_counters = {}
+    for itemid in problem_periods:
+        downtime_periods = merge_downtime_periods(*problem_periods[itemid])
+        seconds_down = sum([end_period - start_period for start_period, end_period in downtime_periods])
+        seconds_down_maintenance = sum([end_period - start_period for start_period, end_period in intersect_intervals(downtime_periods, merge_maintenance_windows(item_maintenance_rows[itemid]))])
+        uptime_counters[itemid] = (end_epoch - start_epoch, seconds_down - seconds_down_maintenance, seconds_down_maintenance, 0, 0, downtime_periods)
+    return uptime_counters
+
+def get_days(start_epoch, end_epoch):
+    # Returns (date, start epoch, end epoch) of every whole day between start_epoch and end_epoch (local time, so days are not always 86400 seconds)
+    days = []
+    day = datetime.date.fromtimestamp(start_epoch)
+    if int(time.mktime(day.timetuple())) < start_epoch:
+        day += datetime.timedelta(days=1)
+    while True:
+        start_day = int(time.mktime(day.timetuple()))
+        end_day = int(time.mktime((day + datetime.timedelta(days=1)).timetuple())) - 1
+        if end_day > end_epoch:
+            break
+        days.append((day, start_day, end_day))
+        day += datetime.timedelta(days=1)
+    return days
+
+def update_uptime_rollup(itemids, start_epoch, end_epoch):
+    # Fills mios_uptime_daily for every whole day between start_epoch and end_epoch which is not rolled up yet.
+    # Only closed days (before today) are rolled up
+    today_epoch = int(time.mktime(datetime.date.today().timetuple()))
+    days = get_days(start_epoch, min(end_epoch, today_epoch - 1))
+    if len(itemids) == 0 or len(days) == 0:
+        return
+    rolled_up = set()
+    rows = postgres.execute(config.postgres_dbname, "select itemid, day from mios_uptime_daily where itemid = any(%s) and day between '%s' and '%s'" % (itemids_array(itemids), days[0][0], days[-1][0]))
+    for row in rows:
+        rolled_up.add((int(row['itemid']), row['day']))
+    # Make sure the maintenance windows of the whole period are cached, so they are not fetched again for every day
+    get_maintenance_cache(start_epoch, end_epoch)
+    for day, start_day, end_day in days:
+        missing_itemids = [itemid for itemid in itemids if (itemid, day) not in rolled_up]
+        if len(missing_itemids) == 0:
+            continue
+        my_logger("Rolling up uptime of %s for items: %s" % (day, missing_itemids), 'info')
+        uptime_counters = get_uptime_counters(missing_itemids, start_day, end_day)
+        for itemid, counters in uptime_counters.items():
+            (polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_periods) = counters
+            downtime_starts = '{' + ','.join([str(period[0]) for period in downtime_periods]) + '}'
+            downtime_ends = '{' + ','.join([str(period[1]) for period in downtime_periods]) + '}'
+            postgres.execute(config.postgres_dbname, "insert into mios_uptime_daily (itemid, day, samples, down, down_in_maintenance, nodata_pollings, nodata_pollings_in_maintenance, downtime_starts, downtime_ends)\
+             values (%s, '%s', %s, %s, %s, %s, %s, '%s', '%s') returning itemid" % (itemid, day, polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_starts, downtime_ends))
+        postgres.commit(config.postgres_dbname)
+
+def get_uptime_counters_rollup(itemids, start_epoch, end_epoch):
+    # Same as get_uptime_counters, but whole days are summed from mios_uptime_daily. Only the parts of the period
+    # which are not a closed day (for example today) are calculated from the history
+    if len(itemids) == 0:
+        return {}
+    update_uptime_rollup(itemids, start_epoch, end_epoch)
+    today_epoch = int(time.mktime(datetime.date.today().timetuple()))
+    days = get_days(start_epoch, min(end_epoch, today_epoch - 1))
+    if len(days) == 0:
+        return get_uptime_counters(itemids, start_epoch, end_epoch)
+    my_logger("Fetching rolled up uptime for items: %s, days between %s and %s" % (itemids, days[0][0], days[-1][0]), 'info')
+    rows = postgres.execute(config.postgres_dbname, "select itemid, samples, down, down_in_maintenance, nodata_pollings, nodata_pollings_in_maintenance, downtime_starts, downtime_ends\
+     from mios_uptime_daily where itemid = any(%s) and day between '%s' and '%s' order by itemid, day" % (itemids_array(itemids), days[0][0], days[-1][0]))
+    uptime_counters = {}
     for row in rows:
-        end_date_nodata = row[0]
-        seconds_nodata = row[1]
-        start_date_nodata = end_date_nodata - seconds_nodata
-        item_nodata_rows.append((start_date_nodata, end_date_nodata))
-    item_nodata_maintenance = []
-    item_nodata = list(item_nodata_rows)  # Make copy of list so that it can be edited without affecting original list (mutable), same as item_nodata_rows[:]
-    for clock in item_nodata_rows:  # Check if the nodata items are within maintenance window
-        for mclock in item_maintenance_rows:
-            if mclock[0] <= clock[0] <= mclock[1]:
-                item_nodata_maintenance.append(clock)
-                item_nodata.remove(clock)
+        uptime_counters.setdefault(int(row['itemid']), []).append((row['samples'], row['down'], row['down_in_maintenance'], row['nodata_pollings'], row['nodata_pollings_in_maintenance'], zip(row['downtime_starts'], row['downtime_ends'])))
+    # The parts of the period before the first and after the last rolled up day
+    if start_epoch < days[0][1]:
+        for itemid, counters in get_uptime_counters(itemids, start_epoch, days[0][1] - 1).items():
+            uptime_counters.setdefault(itemid, []).append(counters)
+    if days[-1][2] + 1 < end_epoch:
+        for itemid, counters in get_uptime_counters(itemids, days[-1][2] + 1, end_epoch).items():
+            uptime_counters.setdefault(itemid, []).append(counters)
+    for itemid in uptime_counters:
+        downtime_periods = merge_downtime_periods(*[counters[5] for counters in uptime_counters[itemid]])
+        uptime_counters[itemid] = (sum([counters[0] for counters in uptime_counters[itemid]]),
+                                   sum([counters[1] for counters in uptime_counters[itemid]]),
+                                   sum([counters[2] for counters in uptime_counters[itemid]]),
+                                   sum([counters[3] for counters in uptime_counters[itemid]]),
+                                   sum([counters[4] for counters in uptime_counters[itemid]]),
+                                   downtime_periods)
+    return uptime_counters
+
+def merge_maintenance_windows(windows):
+    # Sort the maintenance windows and merge the overlapping ones, so every clock falls in at most one window
+    merged_windows = []
+    for start_window, end_window in sorted(windows):
+        if merged_windows and start_window <= merged_windows[-1][1]:
+            merged_windows[-1][1] = max(merged_windows[-1][1], end_window)
+        else:
+            merged_windows.append([start_window, end_window])
+    return merged_windows
+
+def in_maintenance(clock, window_starts, merged_windows):
+    # Binary search for the window which starts last before clock. window_starts are the starts of merged_windows
+    indx = bisect.bisect_right(window_starts, clock) - 1
+    return indx >= 0 and clock <= merged_windows[indx][1]
+
+def classify_maintenance(values, merged_windows, key=None):
+    # Splits values in a list within maintenance and a list outside maintenance. The windows must be merged
+    # with merge_maintenance_windows first. Uses a binary search on the window starts, so O((n+m) log m)
+    window_starts = [window[0] for window in merged_windows]
+    in_maintenance_values = []
+    not_in_maintenance_values = []
+    for value in values:
+        if key:
+            clock = key(value)
+        else:
+            clock = value
+        if in_maintenance(clock, window_starts, merged_windows):
+            in_maintenance_values.append(value)
+        else:
+            not_in_maintenance_values.append(value)
+    return (in_maintenance_values, not_in_maintenance_values)
+
+def count_nodata_python(maintenance_windows, item_interval, item_nodata_rows):
+    # Returns the number of pollings without data in and NOT in maintenance
+    # Check if the nodata items are within maintenance window (based on the start of the nodata period)
+    item_nodata_maintenance, item_nodata = classify_maintenance(item_nodata_rows, maintenance_windows, key=lambda clock: clock[0])
     num_pollings_nodata = 0
     num_pollings_nodata_maintenance = 0
     for item in item_nodata_maintenance:  # Count items with nodata but within maintenance
@@ -558,23 +2207,124 @@ def get_uptime_graph(itemid):
     for item in item_nodata:  # Count items with nodata but not in maintenance
         seconds_nodata = item[1] - item[0]
         num_pollings_nodata += (seconds_nodata / item_interval)
-    my_logger('', 'info')
-    my_logger("Summary for item: %s" % itemid, 'info')
-    my_logger("Polling items with nodata and in maintenance        : %s" % num_pollings_nodata_maintenance, 'info')
-    my_logger("Polling items with nodata and NOT in maintenance    : %s" % num_pollings_nodata, 'info')
-    my_logger("Polling items down and in maintenance               : %s" % len(polling_down_maintenance), 'info')
-    my_logger("Polling items down and NOT in maintenance           : %s" % len(polling_down), 'info')
-    my_logger("Polling items UP                                    : %s" % (polling_total - len(polling_down_maintenance) - len(polling_down)), 'info')
-    my_logger("Start epoch                                         : %s" % start_epoch, 'info')
-    my_logger("Eind epoch                                          : %s" % end_epoch, 'info')
-    my_logger("Period in seconds                                   : %s" % config.report_period, 'info')
+    return (num_pollings_nodata, num_pollings_nodata_maintenance)
+
+def count_uptime_python(polling_down_clocks, maintenance_windows, item_interval, item_nodata_rows):
+    # Pure python version of the uptime math. Returns the number of down pollings (in and NOT in maintenance),
+    # the number of pollings without data (in and NOT in maintenance) and the consecutive downtime runs.
+    # polling_down_clocks can be any iterable of sorted clocks (like a stream from Postgres.stream). The clocks are
+    # classified and grouped in a single pass, so they are never kept in memory
+    (num_pollings_nodata, num_pollings_nodata_maintenance) = count_nodata_python(maintenance_windows, item_interval, item_nodata_rows)
+
+    window_starts = [window[0] for window in maintenance_windows]
+    num_pollings_down = 0
+    num_pollings_down_maintenance = 0
+    # Double interval. Interval is never exact. Allways has a deviation of 1 or 2 seconds. So we double the interval just to be safe
+    interval = item_interval * 2
+    downtime_runs = []
+    start_period = None
+    for clock in polling_down_clocks:
+        if in_maintenance(clock, window_starts, maintenance_windows):
+            num_pollings_down_maintenance += 1
+        else:
+            num_pollings_down += 1
+        # Group the down clocks in consecutive down periods. Every down clock lasts one interval, so the seconds of
+        # the periods match the number of down pollings (see apply_sla_calendar and get_service_uptimes)
+        if start_period is None:
+            start_period = clock
+        elif clock > prev_clock + interval:
+            downtime_runs.append((start_period, end_period))
+            start_period = clock
+        end_period = clock + item_interval
+        prev_clock = clock
+    if start_period is not None:
+        downtime_runs.append((start_period, end_period))
+    return (num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_runs)
+
+def count_uptime_windows(polling_down_clocks, window_starts, end_epoch, maintenance_windows, item_interval, item_nodata_rows):
+    # count_uptime_python for nested windows which all end at end_epoch (window_starts sorted, outer window first).
+    # The clocks are read once: count_uptime_python counts the outer window, while tally_clocks counts the down clocks
+    # per innermost window they fall in. Summing these from the inner to the outer window gives the counters of every
+    # window. The downtime runs of the inner windows are the runs of the outer window cut off at the window start
+    maintenance_starts = [window[0] for window in maintenance_windows]
+    # [NOT in maintenance, in maintenance] per window
+    tally = [[0, 0] for window_start in window_starts]
+
+    def tally_clocks(clocks):
+        for clock in clocks:
+            tally[bisect.bisect_right(window_starts, clock) - 1][in_maintenance(clock, maintenance_starts, maintenance_windows)] += 1
+            yield clock
+
+    downtime_runs = count_uptime_python(tally_clocks(polling_down_clocks), maintenance_windows, item_interval, item_nodata_rows)[4]
+    window_counters = []
+    num_pollings_down = 0
+    num_pollings_down_maintenance = 0
+    for indx in range(len(window_starts) - 1, -1, -1):
+        num_pollings_down += tally[indx][0]
+        num_pollings_down_maintenance += tally[indx][1]
+        # Same as the nodata query for the window: gaps which cross the window start are cut off at it
+        (num_pollings_nodata, num_pollings_nodata_maintenance) = count_nodata_python(maintenance_windows, item_interval, intersect_intervals(item_nodata_rows, [(window_starts[indx], end_epoch + 1)]))
+        window_counters.insert(0, (num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, intersect_intervals(downtime_runs, [(window_starts[indx], end_epoch)])))
+    return window_counters
+
+def count_uptime_numpy(polling_down_clocks, maintenance_windows, item_interval, item_nodata_rows):
+    # NumPy version of count_uptime_python. Gives exactly the same results, but without python loops over the clocks
+    window_starts = numpy.array([window[0] for window in maintenance_windows], dtype=numpy.int64)
+    window_ends = numpy.array([window[1] for window in maintenance_windows], dtype=numpy.int64)
+
+    def in_maintenance(clocks):
+        if len(window_starts) == 0:
+            return numpy.zeros(len(clocks), dtype=bool)
+        indx = numpy.searchsorted(window_starts, clocks, side='right') - 1
+        return (indx >= 0) & (clocks <= window_ends[numpy.maximum(indx, 0)])
+
+    # The clocks are sorted already and are read straight from the iterable into the array
+    polling_down_clocks = numpy.fromiter(polling_down_clocks, dtype=numpy.int64)
+    down_maintenance = in_maintenance(polling_down_clocks)
+    num_pollings_down_maintenance = int(numpy.count_nonzero(down_maintenance))
+    num_pollings_down = len(polling_down_clocks) - num_pollings_down_maintenance
+
+    nodata = numpy.array(item_nodata_rows, dtype=numpy.int64).reshape(-1, 2)
+    pollings_nodata = (nodata[:, 1] - nodata[:, 0]) // item_interval
+    nodata_maintenance = in_maintenance(nodata[:, 0])
+    num_pollings_nodata_maintenance = int(pollings_nodata[nodata_maintenance].sum())
+    num_pollings_nodata = int(pollings_nodata[~nodata_maintenance].sum())
+
+    # Run-length grouping of the down clocks. A new run starts where the gap to the previous down clock is too large
+    downtime_runs = []
+    if len(polling_down_clocks) > 0:
+        interval = item_interval * 2
+        breaks = numpy.flatnonzero(numpy.diff(polling_down_clocks) > interval)
+        run_first = numpy.concatenate(([0], breaks + 1))
+        run_last = numpy.concatenate((breaks, [len(polling_down_clocks) - 1]))
+        run_starts = polling_down_clocks[run_first]
+        run_ends = polling_down_clocks[run_last] + item_interval
+        downtime_runs = zip(run_starts.tolist(), run_ends.tolist())
+    return (num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_runs)
+
+def calculate_uptime(itemid, polling_total, polling_down_clocks, item_maintenance_rows, item_interval, item_nodata_rows):
+    my_logger('Check if downtime was in maintenance', 'info')
+    maintenance_windows = merge_maintenance_windows(item_maintenance_rows)
+    if config.uptime_engine == 'numpy' and numpy:
+        counters = count_uptime_numpy(polling_down_clocks, maintenance_windows, item_interval, item_nodata_rows)
+    else:
+        counters = count_uptime_python(polling_down_clocks, maintenance_windows, item_interval, item_nodata_rows)
+    (num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_runs) = counters
+
+    # Generate table overview of down time (get consecutive down periods)
+    my_logger("Generate downtime rows to be displayed in Word as table for item: %s" % itemid, 'info')
+    # Both the downtime runs and the nodata rows are sorted on clock
+    downtime_periods = merge_downtime_periods(downtime_runs, item_nodata_rows)
+    return (polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_periods)
 
+def uptime_percentages(polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance):
+    # Returns the percentage up, down and down in maintenance of the counters
     try:
-        percentage_down_maintenance = (float(len(polling_down_maintenance) + num_pollings_nodata_maintenance) / float(polling_total)) * 100
+        percentage_down_maintenance = (float(num_pollings_down_maintenance + num_pollings_nodata_maintenance) / float(polling_total)) * 100
     except ZeroDivisionError:
         percentage_down_maintenance = 0
     try:
-        percentage_down = (float(len(polling_down) + num_pollings_nodata) / float(polling_total)) * 100
+        percentage_down = (float(num_pollings_down + num_pollings_nodata) / float(polling_total)) * 100
         if percentage_down > 100:
             percentage_down = 100
     except ZeroDivisionError:
@@ -582,6 +2332,22 @@ def get_uptime_graph(itemid):
     percentage_up = 100 - (percentage_down + percentage_down_maintenance)
     if percentage_up < 0:
         percentage_up = 0
+    return (percentage_up, percentage_down, percentage_down_maintenance)
+
+def summarize_uptime(itemid, start_epoch, end_epoch, polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance, downtime_periods):
+    # Turns the counters of an item into percentages and the pie chart
+    my_logger('', 'info')
+    my_logger("Summary for item: %s" % itemid, 'info')
+    my_logger("Polling items with nodata and in maintenance        : %s" % num_pollings_nodata_maintenance, 'info')
+    my_logger("Polling items with nodata and NOT in maintenance    : %s" % num_pollings_nodata, 'info')
+    my_logger("Polling items down and in maintenance               : %s" % num_pollings_down_maintenance, 'info')
+    my_logger("Polling items down and NOT in maintenance           : %s" % num_pollings_down, 'info')
+    my_logger("Polling items UP                                    : %s" % (polling_total - num_pollings_down_maintenance - num_pollings_down), 'info')
+    my_logger("Start epoch                                         : %s" % start_epoch, 'info')
+    my_logger("Eind epoch                                          : %s" % end_epoch, 'info')
+    my_logger("Period in seconds                                   : %s" % (end_epoch - start_epoch), 'info')
+
+    (percentage_up, percentage_down, percentage_down_maintenance) = uptime_percentages(polling_total, num_pollings_down, num_pollings_down_maintenance, num_pollings_nodata, num_pollings_nodata_maintenance)
     my_logger("Percentage down and in maintenanve during period    : %s" % percentage_down_maintenance, 'info')
     my_logger("Percentage down and NOT in maintenance during period: %s" % percentage_down, 'info')
     my_logger("Percentage up during period                         : %s" % percentage_up, 'info')
@@ -594,51 +2360,81 @@ def get_uptime_graph(itemid):
     uptime_graph.color('00dd00', 'dd0000', 'ff8800')
     uptime_graph.save(mreport_home + '/' + str(itemid) + '.png')
 
-    # Generate table overview of down time (get consecutive down periods)
-    my_logger("Generate downtime rows to be displayed in Word as table for item: %s" % itemid, 'info')
-    item_interval *= 2  # Double interval. Interval is never exact. Allways has a deviation of 1 or 2 seconds. So we double the interval just to be safe
-    my_logger("Doubling interval for item: %s. Interval is never exact. Allways a deviation of a couple of seconds. So double it just to be safe" % itemid, 'info')
-    my_logger("New interval for itemid: %s, %s" % (itemid, item_interval), 'info')
-    downtime_periods = []
-    polling_down_rows.sort()  # Sort the list to get consecutive downtimes
-    if len(polling_down_rows) > 0:
-        for num in range(len(polling_down_rows)):
-            if num == 0:
-                start_period = polling_down_rows[num]
-                prev_clock = start_period
-                end_period = start_period + item_interval
-            else:
-                if polling_down_rows[num] <= prev_clock + item_interval:
-                    # Consecutive down time
-                    end_period = polling_down_rows[num]
-                    prev_clock = polling_down_rows[num]
-                else:
-                    end_period = start_period + item_interval
-                    downtime_periods.append((start_period, end_period))
-                    start_period = polling_down_rows[num]
-                    prev_clock = polling_down_rows[num]
-        downtime_periods.append((start_period, end_period))
-    # Append nodata rows to downtime_periods
-    for nodata_rows in item_nodata_rows:
-        downtime_periods.append(nodata_rows)
-    try:
-        downtime_periods = list(merge_tuples_epoch_times(downtime_periods))
-    except:
-        pass
     my_logger("Downtime periods: %s" % downtime_periods, 'debug')
     return (downtime_periods, percentage_up, percentage_down, percentage_down_maintenance)
 
-
-def merge_tuples_epoch_times(times):
-    saved = list(times[0])
-    for st, en in sorted([sorted(t) for t in times]):
-        if st <= saved[1]:
-            saved[1] = max(saved[1], en)
+def get_uptime_counters_database(itemids, start_epoch, end_epoch):
+    # The uptime is calculated inside postgres by the function mios_uptime (see sql/04_uptime_functions.sql)
+    # so only one summary row per item is transferred in stead of all the down clocks
+    my_logger("Fetching uptime summary from database for items: %s, epoch between %s and %s" % (itemids, start_epoch, end_epoch), 'info')
+    rows = postgres.execute(config.postgres_dbname, "select itemid, polling_total, pollings_down, pollings_down_maintenance, pollings_nodata, pollings_nodata_maintenance, downtime_starts, downtime_ends\
+     from mios_uptime(%s, %s, %s)" % (itemids_array(itemids), start_epoch, end_epoch))
+    uptime_counters = {}
+    if not isinstance(rows, list):
+        my_logger("Could not fetch the uptime summary from database for items: %s" % itemids, 'error')
+        return uptime_counters
+    for row in rows:
+        downtime_periods = zip(row['downtime_starts'], row['downtime_ends'])
+        uptime_counters[int(row['itemid'])] = (row['polling_total'], row['pollings_down'], row['pollings_down_maintenance'], row['pollings_nodata'], row['pollings_nodata_maintenance'], downtime_periods)
+    return uptime_counters
+
+
+def get_heatmap_days(start_epoch, end_epoch):
+    # Returns (date, start epoch, end epoch) of the calendar days of the period, like get_days. The days are counted
+    # from the date of start_epoch in stead of ending at end_epoch: a period of 31 * 86400 seconds doesn't cover the
+    # whole last day of a month with the change from daylight saving time, but that day is still part of the report
+    days = []
+    day = datetime.date.fromtimestamp(start_epoch)
+    for num in range(int(round((end_epoch - start_epoch) / 86400.0))):
+        start_day = int(time.mktime(day.timetuple()))
+        end_day = int(time.mktime((day + datetime.timedelta(days=1)).timetuple())) - 1
+        days.append((day, start_day, end_day))
+        day += datetime.timedelta(days=1)
+    return days
+
+def get_heatmap_buckets(start_epoch, end_epoch, hourly=False):
+    # Returns the (start, end) of every day (or every hour of every day) in the period. The end is not part of the
+    # bucket. The hours of a day with a daylight saving time change are not all 3600 seconds: the last hour takes the rest.
+    # The buckets are cut off at the period, so the parts of the first and the last day outside of it don't count
+    buckets = []
+    for day, start_day, end_day in get_heatmap_days(start_epoch, end_epoch):
+        if hourly:
+            day_buckets = [(min(start_day + hour * 3600, end_day + 1), end_day + 1 if hour == 23 else min(start_day + (hour + 1) * 3600, end_day + 1)) for hour in range(24)]
+        else:
+            day_buckets = [(start_day, end_day + 1)]
+        for start_bucket, end_bucket in day_buckets:
+            start_bucket = min(max(start_bucket, start_epoch), end_epoch)
+            buckets.append((start_bucket, min(max(end_bucket, start_bucket), end_epoch)))
+    return buckets
+
+def get_heatmap(downtime_periods, buckets):
+    # Returns the percentage available of every bucket. The downtime periods (sorted and merged, like the output of
+    # get_uptime_graphs) are intersected with the buckets in one linear pass, so no extra queries are needed
+    bucket_starts = [bucket[0] for bucket in buckets]
+    seconds_down = [0] * len(buckets)
+    for start_period, end_period in intersect_intervals(downtime_periods, buckets):
+        seconds_down[bisect.bisect_right(bucket_starts, start_period) - 1] += end_period - start_period
+    return [100 - 100.0 * seconds_down[indx] / (end_bucket - start_bucket) if end_bucket > start_bucket else 100 for indx, (start_bucket, end_bucket) in enumerate(buckets)]
+
+def heatmap_color(percentage_up):
+    for minimum, color in ((100, '00DD00'), (99, 'FFDD00'), (95, 'FF8800')):
+        if percentage_up >= minimum:
+            return color
+    return 'DD0000'
+
+def merge_downtime_periods(*streams):
+    # Merges (start, end) periods into a sorted list of non overlapping periods. Every stream must be sorted on start
+    # already (downtime runs, nodata rows and daily rollups are produced in clock order), so the streams are
+    # combined with a k-way merge and the overlapping periods are joined in a single linear pass.
+    # Periods which touch (start of one equals the end of the previous) are joined as well
+    merged_periods = []
+    for start_period, end_period in heapq.merge(*streams):
+        if merged_periods and start_period <= merged_periods[-1][1]:
+            if end_period > merged_periods[-1][1]:
+                merged_periods[-1] = (merged_periods[-1][0], end_period)
         else:
-            yield tuple(saved)
-            saved[0] = st
-            saved[1] = en
-    yield tuple(saved)
+            merged_periods.append((start_period, end_period))
+    return merged_periods
 
 
 def get_maintenance_periods(hostgroupid):
@@ -646,12 +2442,10 @@ def get_maintenance_periods(hostgroupid):
     start_epoch = int(time.mktime((year, month, day, 0, 0, 0, 0, 0, 0)))
     end_epoch = start_epoch + config.report_period
     my_logger("Fetching maintenance rows for hostgroupid: %s, epoch between %s and %s" % (hostgroupid, start_epoch, end_epoch), 'info')
-    maintenance_rows = postgres.execute(config.postgres_dbname, "select maintenances.name || '. ' || maintenances.description, start_date, (start_date + period) from timeperiods\
-     inner join maintenances_windows on maintenances_windows.timeperiodid = timeperiods.timeperiodid\
-     inner join maintenances on maintenances.maintenanceid = maintenances_windows.maintenanceid\
-     inner join maintenances_groups on maintenances_groups.maintenanceid = maintenances.maintenanceid\
-     inner join groups on maintenances_groups.groupid = groups.groupid\
-     where groups.groupid = %s and timeperiods.start_date between %s and %s" % (hostgroupid, start_epoch, end_epoch))
+    maintenance_cache = get_maintenance_cache(start_epoch, end_epoch)
+    # Load the windows of the whole hostgroup at once. The uptime calculation of the items uses them later on
+    maintenance_cache.load_hostgroup(hostgroupid)
+    maintenance_rows = maintenance_cache.get_group_windows(hostgroupid)
     my_logger("Maintenance rows: %s" % maintenance_rows, 'debug')
     return maintenance_rows
 
@@ -666,6 +2460,21 @@ def get_items_list(hostgroupid):
     return postgres.execute(config.postgres_dbname, "select * from mios_report_uptime where hostgroupid = %s order by hostname, itemname" % hostgroupid)
 
 
+def get_services_list(hostgroupid):
+    # Business services are optional. Without the tables from sql/06_business_services.sql there are no services
+    rows = postgres.execute(config.postgres_dbname, "select count(*) from information_schema.tables where table_name = 'mios_report_services'")
+    if not isinstance(rows, list) or rows[0][0] == 0:
+        my_logger('Table mios_report_services not installed. No business services in report', 'debug')
+        return []
+    my_logger("Fetching business services for hostgroup (%s)" % hostgroupid, 'info')
+    servicesList = postgres.execute(config.postgres_dbname, "select mios_report_services.serviceid, servicename, operator, itemid from mios_report_services\
+     inner join mios_report_service_items on mios_report_service_items.serviceid = mios_report_services.serviceid\
+     where hostgroupid = %s order by servicename, mios_report_services.serviceid, itemid" % hostgroupid)
+    if not isinstance(servicesList, list):
+        return []
+    return servicesList
+
+
 def get_backup_list(itemid):
     day, month, year = map(int, config.report_start_date.split('-'))
 
@@ -738,10 +2547,11 @@ def send_report(filename, hostgroupname):
     mailer.quit()
 
 
-def generate_report(hostgroupid, hostgroupname, graphData, itemData):
+def generate_report(hostgroupid, hostgroupname, graphData, itemData, serviceData):
     import docx
 
     my_logger('Starting report generation', 'info')
+    prefetch_graphs(graphData)
     if config.report_template == '':
         existing_report = ''
         my_logger('Using the default docx template', 'info')
@@ -793,14 +2603,9 @@ def generate_report(hostgroupid, hostgroupname, graphData, itemData):
         for record in graphData:
             if record['graphtype'] == 'c':
                 my_logger("Generating custom graph '%s'" % record['graphname'], 'info')
-                get_graph(record['graphid'], 'c')
+                image = get_graph(record['graphid'], 'c')
                 body.append(docx.heading(record['graphname'], 3, lang=config.report_template_language))
-                try:
-                    relationships, picpara = docx.picture(relationships, mreport_home + '/' + str(record['graphid']) + '_c.png', record['graphname'], 450)
-                except:
-                    my_logger('Reading graph image file failed. Possible timing issue. Retry in 2 seconds', 'warning')
-                    time.sleep(2)  # Timing issues can occur when get_graph is writing image and docx.picture tries to read image
-                    relationships, picpara = docx.picture(relationships, mreport_home + '/' + str(record['graphid']) + '_c.png', record['graphname'], 450)
+                relationships, picpara = docx.picture(relationships, str(record['graphid']) + '_c.png', record['graphname'], 450, imagedata=image)
                 body.append(picpara)
                 body.append(docx.figureCaption(record['graphname'], lang=config.report_template_language))
     body.append(docx.heading("Beschikbaarheid business services", 2, lang=config.report_template_language))
@@ -811,17 +2616,23 @@ def generate_report(hostgroupid, hostgroupname, graphData, itemData):
         if record['graphtype'] == 'w':
             num_web_check_found += 1
             my_logger("Generating web-check graph '%s'" % record['graphname'], 'info')
-            get_graph(record['graphid'], 'w')
-            try:
-                relationships, picpara = docx.picture(relationships, mreport_home + '/' + str(record['graphid']) + '_w.png', record['graphname'], 450)
-            except:
-                my_logger('Reading graph image file failed. Possible timing issue. Retry in 2 seconds', 'warning')
-                time.sleep(2)  # Timing issues can occur when get_graph is writing image and docx.picture tries to read image
-                relationships, picpara = docx.picture(relationships, mreport_home + '/' + str(record['graphid']) + '_w.png', record['graphname'], 450)
+            image = get_graph(record['graphid'], 'w')
+            relationships, picpara = docx.picture(relationships, str(record['graphid']) + '_w.png', record['graphname'], 450, imagedata=image)
             if num_web_check_found == 1:
                 body.append(docx.heading("Web-check", 3, lang=config.report_template_language))
             body.append(picpara)
             body.append(docx.figureCaption(record['graphname'], lang=config.report_template_language))
+    # Business services which are backed by several items (mios_report_services)
+    service_uptimes = get_service_uptimes(serviceData)
+    if len(service_uptimes) > 0:
+        body.append(docx.paragraph(''))
+        tbl_rows = []
+        tbl_heading = ['SERVICE', 'Percentage down', 'Percentage down - maintenance', 'Percentage up']
+        tbl_rows.append(tbl_heading)
+        for servicename, (downtime_periods, percentage_up, percentage_down, percentage_down_maintenance) in service_uptimes:
+            my_logger("Generating uptime table_row for service '%s'" % servicename, 'info')
+            tbl_rows.append([servicename, '%.2f' % percentage_down, '%.2f' % percentage_down_maintenance, '%.2f' % percentage_up])
+        body.append(docx.table(tbl_rows, headingFillColor=config.table_header_color, firstColFillColor=config.table_first_column_color))
     hosts = []
     for record in graphData:  # Create list of hosts for iteration
         if record['hostname'] not in hosts:
@@ -836,15 +2647,22 @@ def generate_report(hostgroupid, hostgroupname, graphData, itemData):
     body.append(docx.paragraph(''))
     tbl_rows = []
     tbl_heading = ['VPN', 'Percentage down', 'Percentage down - maintenance', 'Percentage up']
+    # Extra columns with the percentage up of the configured windows (qtd, ytd)
+    tbl_heading.extend(['Percentage up %s' % window.upper() for window in config.uptime_windows])
     tbl_rows.append(tbl_heading)
 
+    # Fetch the uptime of all items at once. This is a lot faster then fetching it item by item
+    if config.uptime_windows:
+        uptime_graphs, window_percentages = get_uptime_windows([record['itemid'] for record in itemData], config.uptime_windows)
+    else:
+        uptime_graphs = get_uptime_graphs([record['itemid'] for record in itemData])
     for item in uptime_items:
 #        body.append(docx.heading(item, 3, lang=config.report_template_language))
         for record in itemData:
             if record['itemname'] == item:
 #                my_logger("Generating uptime graph '%s' from item '%s'" % (record['itemname'], item), 'info')
                 my_logger("Generating uptime table_row '%s' from item '%s'" % (record['itemname'], item), 'info')
-                (downtime_periods, percentage_up, percentage_down, percentage_down_maintenance) = get_uptime_graph(record['itemid'])
+                (downtime_periods, percentage_up, percentage_down, percentage_down_maintenance) = uptime_graphs[int(record['itemid'])]
 #                try:
 #                    relationships, picpara = docx.picture(relationships, mreport_home + '/' + str(record['itemid']) + '.png', record['itemname'], 200, jc='center')
 #                except:
@@ -872,8 +2690,48 @@ def generate_report(hostgroupid, hostgroupname, graphData, itemData):
                 tbl_row.append('%.2f' % percentage_down)
                 tbl_row.append('%.2f' % percentage_down_maintenance)
                 tbl_row.append('%.2f' % percentage_up)
+                if config.uptime_windows:
+                    for percentages in window_percentages[int(record['itemid'])]:
+                        tbl_row.append('' if percentages is None else '%.2f' % percentages[0])
                 tbl_rows.append(tbl_row)
     body.append(docx.table(tbl_rows, headingFillColor=config.table_header_color, firstColFillColor=config.table_first_column_color))
+    # Heatmap of the availability per day (one row per item) or per hour (one table per item with a row per day)
+    if config.uptime_heatmap in ('day', 'hour'):
+        day, month, year = map(int, config.report_start_date.split('-'))
+        start_epoch = int(time.mktime((year, month, day, 0, 0, 0, 0, 0, 0)))
+        end_epoch = start_epoch + config.report_period
+        days = get_heatmap_days(start_epoch, end_epoch)
+        replace_strings = get_replace_strings(hostgroupid)
+        heatmap_items = []
+        for record in itemData:
+            uptime_item_name = record['itemname']
+            for string, replace_by in replace_strings.items():
+                uptime_item_name = uptime_item_name.replace(string, replace_by)
+            heatmap_items.append((uptime_item_name, uptime_graphs[int(record['itemid'])][0]))
+        if config.uptime_heatmap == 'day':
+            body.append(docx.heading("Beschikbaarheid per dag", 3, lang=config.report_template_language))
+            buckets = get_heatmap_buckets(start_epoch, end_epoch)
+            tbl_rows = [['ITEM'] + [str(day.day) for day, start_day, end_day in days]]
+            tbl_colors = []
+            for uptime_item_name, downtime_periods in heatmap_items:
+                my_logger("Generating heatmap row for item '%s'" % uptime_item_name, 'info')
+                tbl_rows.append([uptime_item_name] + [''] * len(buckets))
+                tbl_colors.append([None] + [heatmap_color(percentage_up) for percentage_up in get_heatmap(downtime_periods, buckets)])
+            body.append(docx.table(tbl_rows, colw=[1800] + [230] * len(buckets), headingFillColor=config.table_header_color, firstColFillColor=config.table_first_column_color, cellFillColors=tbl_colors))
+        else:
+            body.append(docx.heading("Beschikbaarheid per uur", 3, lang=config.report_template_language))
+            buckets = get_heatmap_buckets(start_epoch, end_epoch, hourly=True)
+            for uptime_item_name, downtime_periods in heatmap_items:
+                my_logger("Generating heatmap table for item '%s'" % uptime_item_name, 'info')
+                body.append(docx.paragraph(uptime_item_name))
+                heatmap = get_heatmap(downtime_periods, buckets)
+                tbl_rows = [['DAG'] + [str(hour) for hour in range(24)]]
+                tbl_colors = []
+                for indx, (day, start_day, end_day) in enumerate(days):
+                    tbl_rows.append([day.strftime("%d-%m")] + [''] * 24)
+                    tbl_colors.append([None] + [heatmap_color(percentage_up) for percentage_up in heatmap[indx * 24:(indx + 1) * 24]])
+                body.append(docx.table(tbl_rows, colw=[1000] + [330] * 24, headingFillColor=config.table_header_color, firstColFillColor=config.table_first_column_color, cellFillColors=tbl_colors))
+        body.append(docx.paragraph("Groen: 100% beschikbaar, geel: minimaal 99%, oranje: minimaal 95%, rood: minder dan 95% beschikbaar (inclusief maintenance)."))
     # Maintenance periodes
     body.append(docx.heading("Maintenance-overzicht", 3, lang=config.report_template_language))
     # De gegevens zijn al gegenereerd bij de samenvatting. Dus er hoeft alleen nog maar gekeken te worden of het nogmaals toegevoegd moet worden
@@ -911,13 +2769,8 @@ def generate_report(hostgroupid, hostgroupname, graphData, itemData):
             for record in graphData:
                 if record['hostname'] == host and (record['graphtype'] == 'p' or record['graphtype'] == 'r'):
                     my_logger("Generating performance graph '%s' from host '%s'" % (record['graphname'], host), 'info')
-                    get_graph(record['graphid'], 'p')
-                    try:
-                        relationships, picpara = docx.picture(relationships, mreport_home + '/' + str(record['graphid']) + '_p.png', record['graphname'], 450)
-                    except:
-                        my_logger('Reading graph image file failed. Possible timing issue. Retry in 2 seconds', 'warning')
-                        time.sleep(2)  # Timing issues can occur when get_graph is writing image and docx.picture tries to read image
-                        relationships, picpara = docx.picture(relationships, mreport_home + '/' + str(record['graphid']) + '_p.png', record['graphname'], 450)
+                    image = get_graph(record['graphid'], 'p')
+                    relationships, picpara = docx.picture(relationships, str(record['graphid']) + '_p.png', record['graphname'], 450, imagedata=image)
                     body.append(picpara)
                     body.append(docx.figureCaption(record['graphname'], lang=config.report_template_language))
 #           body.append(docx.pagebreak(type='page', orient='portrait'))
@@ -942,13 +2795,8 @@ def generate_report(hostgroupid, hostgroupname, graphData, itemData):
             for record in graphData:
                 if record['hostname'] == host and (record['graphtype'] == 't' or record['graphtype'] == 'r'):
                     my_logger("Generating trending graph '%s' from host '%s'" % (record['graphname'], host), 'info')
-                    get_graph(record['graphid'], 't')
-                    try:
-                        relationships, picpara = docx.picture(relationships, mreport_home + '/' + str(record['graphid']) + '_t.png', record['graphname'], 450)
-                    except:
-                        my_logger('Reading graph image file failed. Possible timing issue. Retry in 2 seconds', 'warning')
-                        time.sleep(2)  # Timing issues can occur when get_graph is writing image and docx.picture tries to read image
-                        relationships, picpara = docx.picture(relationships, mreport_home + '/' + str(record['graphid']) + '_t.png', record['graphname'], 450)
+                    image = get_graph(record['graphid'], 't')
+                    relationships, picpara = docx.picture(relationships, str(record['graphid']) + '_t.png', record['graphname'], 450, imagedata=image)
                     body.append(picpara)
                     body.append(docx.figureCaption(record['graphname'], lang=config.report_template_language))
 
@@ -1040,8 +2888,6 @@ def generate_report(hostgroupid, hostgroupname, graphData, itemData):
         websettings = docx.websettings()
         docx.savedocx(document, coreprops, appprops, contenttypes, websettings, wordrelationships, mreport_home + '/' + config.report_name)
     else:
-        for file in glob.glob(mreport_home + '/lib/template/word/media/*'):
-            shutil.copy2(file, mreport_home + '/tmp/word/media/')
         docx.savedocx(document, coreprops, wordrelationships=wordrelationships, output=mreport_home + '/' + config.report_name, template=existing_report, tmp_folder=mreport_home + '/tmp')
     my_logger('Done creating docx', 'info')
     #send it through email
@@ -1070,12 +2916,12 @@ def dhms(seconds):
 def cleanup():
     my_logger('', 'info')
     my_logger('Starting cleanup', 'info')
+    if graph_fetcher is not None:
+        graph_fetcher.close()
     # Remove files which are no longer necessary
     my_logger('Removing generated graph images', 'info')
     for file in glob.glob(mreport_home + '/*.png'):
         os.remove(file)
-    for file in glob.glob(mreport_home + '/lib/template/word/media/*'):
-        os.remove(file)
     my_logger('Removing files from tmp folders', 'info')
     for root, dirs, files in os.walk(mreport_home + '/tmp/', topdown=False):
         for name in files:
@@ -1104,12 +2950,16 @@ def initialize():
         sys.exit(1)
 
 
-def main():
+def main(rollup=False):
     global postgres
     import atexit
     atexit.register(cleanup)
 
-    postgres = Postgres(config.postgres_dbs)
+    if config.uptime_workers > 1:
+        # Every uptime worker thread needs its own database connection
+        postgres = PostgresPool(config.postgres_dbs, config.postgres_itersize)
+    else:
+        postgres = Postgres(config.postgres_dbs, config.postgres_itersize)
     my_logger('============================= Starting Zabbix-REPORT ==================================', 'info')
     # get hostgroup
     if not config.hostgroupid:
@@ -1131,7 +2981,16 @@ def main():
         # get the hosts and their graphs from selected host group
         graphsList = get_graphs_list(hostgroupid)
         itemsList = get_items_list(hostgroupid)
-        generate_report(hostgroupid, hostgroupname, graphsList, itemsList)
+        servicesList = get_services_list(hostgroupid)
+        if rollup:
+            # Only roll up the uptime of the closed days in the report period. Don't generate a report
+            day, month, year = map(int, config.report_start_date.split('-'))
+            start_epoch = int(time.mktime((year, month, day, 0, 0, 0, 0, 0, 0)))
+            end_epoch = start_epoch + config.report_period
+            my_logger("Rolling up uptime for hostgroup '%s'" % hostgroupname, 'info')
+            update_uptime_rollup(list(set([int(record['itemid']) for record in itemsList] + [int(record['itemid']) for record in servicesList])), start_epoch, end_epoch)
+        else:
+            generate_report(hostgroupid, hostgroupname, graphsList, itemsList, servicesList)
     my_logger('============================= Ending Zabbix-REPORT ====================================', 'info')
 
 if __name__ == "__main__":
@@ -1144,6 +3003,8 @@ if __name__ == "__main__":
     usage = "usage: %prog [options] <start_date: dd-mm-yyyy>"
     parser = OptionParser(usage=usage, version="%prog " + __version__)
     parser.add_option("-c", "--customer", dest="customer_conf_file", metavar="FILE", help="file which contains report information for customer")
+    parser.add_option("-r", "--rollup", dest="rollup", action="store_true", default=False, help="only roll up the daily uptime of the closed days in the report period (mios_uptime_daily), don't generate a report")
+    parser.add_option("-f", "--recompute", dest="recompute", action="store_true", default=False, help="recalculate the uptime in stead of using the cached results (mios_uptime_results)")
     (options, args) = parser.parse_args()
     if not options.customer_conf_file:
         parser.error("No option given")
@@ -1161,6 +3022,7 @@ if __name__ == "__main__":
 
     config = Config(config_file, customer_conf_file)
     config.parse()
+    config.uptime_recompute = options.recompute
     try:
         logging.config.fileConfig(mreport_home + '/conf/logging.conf')
     except:
@@ -1169,4 +3031,4 @@ if __name__ == "__main__":
         sys.exit(1)
     
     initialize()
-    main()
+    main(options.rollup)
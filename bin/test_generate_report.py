@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# Tests for the downtime period helpers of generate_report.py
+# Run with: python -m unittest discover -s bin -p 'test_*.py'
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('MREPORT_HOME', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generate_report
+
+
+class MergeDowntimePeriodsTest(unittest.TestCase):
+
+    def test_no_streams(self):
+        self.assertEqual(generate_report.merge_downtime_periods(), [])
+
+    def test_empty_streams(self):
+        self.assertEqual(generate_report.merge_downtime_periods([], []), [])
+
+    def test_separate_periods(self):
+        self.assertEqual(generate_report.merge_downtime_periods([(10, 20), (30, 40)]), [(10, 20), (30, 40)])
+
+    def test_touching_periods(self):
+        self.assertEqual(generate_report.merge_downtime_periods([(10, 20), (20, 30)]), [(10, 30)])
+
+    def test_overlapping_periods(self):
+        self.assertEqual(generate_report.merge_downtime_periods([(10, 25), (20, 30)]), [(10, 30)])
+
+    def test_nested_periods(self):
+        self.assertEqual(generate_report.merge_downtime_periods([(10, 50), (20, 30), (40, 45)]), [(10, 50)])
+
+    def test_periods_across_streams(self):
+        downtime_runs = [(10, 20), (60, 70)]
+        nodata_rows = [(15, 30), (40, 50)]
+        rollups = [(0, 5), (65, 80)]
+        self.assertEqual(generate_report.merge_downtime_periods(downtime_runs, nodata_rows, rollups), [(0, 5), (10, 30), (40, 50), (60, 80)])
+
+    def test_touching_periods_across_streams(self):
+        self.assertEqual(generate_report.merge_downtime_periods([(10, 20)], [(20, 30)], [(30, 40)]), [(10, 40)])
+
+
+class IntersectIntervalsTest(unittest.TestCase):
+
+    def test_no_intervals(self):
+        self.assertEqual(generate_report.intersect_intervals([], [(0, 100)]), [])
+
+    def test_no_windows(self):
+        self.assertEqual(generate_report.intersect_intervals([(0, 100)], []), [])
+
+    def test_interval_within_window(self):
+        self.assertEqual(generate_report.intersect_intervals([(20, 30)], [(0, 100)]), [(20, 30)])
+
+    def test_interval_across_windows(self):
+        self.assertEqual(generate_report.intersect_intervals([(0, 100)], [(10, 20), (50, 60)]), [(10, 20), (50, 60)])
+
+    def test_partial_overlap(self):
+        self.assertEqual(generate_report.intersect_intervals([(0, 15), (45, 70)], [(10, 50), (60, 80)]), [(10, 15), (45, 50), (60, 70)])
+
+    def test_touching_intervals_are_left_out(self):
+        self.assertEqual(generate_report.intersect_intervals([(0, 10), (50, 60)], [(10, 50)]), [])
+
+
+class CountUptimePythonTest(unittest.TestCase):
+
+    def test_single_down_clocks_last_one_interval(self):
+        # One down polling per hour: the seconds of the periods match the number of down pollings
+        counters = generate_report.count_uptime_python([0, 3600, 7200], [], 60, [])
+        self.assertEqual(counters[0], 3)
+        self.assertEqual(counters[4], [(0, 60), (3600, 3660), (7200, 7260)])
+
+    def test_consecutive_down_clocks(self):
+        counters = generate_report.count_uptime_python([0, 60, 120, 600], [], 60, [])
+        self.assertEqual(counters[4], [(0, 180), (600, 660)])
+
+    @unittest.skipIf(generate_report.numpy is None, 'numpy is not installed')
+    def test_same_periods_as_numpy(self):
+        clocks = [0, 60, 121, 600, 3600, 3700]
+        self.assertEqual(generate_report.count_uptime_numpy(clocks, [], 60, [])[4], generate_report.count_uptime_python(clocks, [], 60, [])[4])
+
+
+class CountUptimeWindowsTest(unittest.TestCase):
+
+    def test_clock_at_outer_window_start(self):
+        windows = generate_report.count_uptime_windows([1000], [1000, 2000, 3000], 4000, [], 60, [])
+        self.assertEqual([window[0] for window in windows], [1, 0, 0])
+
+    def test_clock_at_inner_window_start(self):
+        windows = generate_report.count_uptime_windows([3000], [1000, 2000, 3000], 4000, [], 60, [])
+        self.assertEqual([window[0] for window in windows], [1, 1, 1])
+
+    def test_nodata_across_window_start(self):
+        # Same as get_uptime_counters for the window: the gap is cut off at the window start
+        windows = generate_report.count_uptime_windows([], [1000, 2000], 4000, [], 60, [(1700, 2300)])
+        self.assertEqual([window[2] for window in windows], [10, 5])
+
+
+class ItemStatesTest(unittest.TestCase):
+
+    def test_down_with_own_interval(self):
+        states = generate_report.ItemStates(0, 600, 60)
+        states.add_down([0, 120])
+        self.assertEqual(states.periods(states.down), [(0, 60), (120, 180)])
+
+    def test_down_with_larger_item_interval(self):
+        # A 5 minute item which is down the whole time, in buckets of 1 minute
+        states = generate_report.ItemStates(0, 600, 60)
+        states.add_down([0, 300], 300)
+        self.assertEqual(states.periods(states.down), [(0, 600)])
+
+    def test_down_at_end_of_period(self):
+        states = generate_report.ItemStates(0, 600, 60)
+        states.add_down([540], 300)
+        self.assertEqual(states.periods(states.down), [(540, 600)])
+
+    def test_service_with_mixed_intervals(self):
+        fast_member = generate_report.ItemStates(0, 600, 60)
+        slow_member = generate_report.ItemStates(0, 600, 60)
+        slow_member.add_down([0, 300], 300)
+        self.assertEqual(generate_report.calculate_service_uptime_bitmap([fast_member, slow_member], False), ([(0, 600)], 600, 0))
+        self.assertEqual(generate_report.calculate_service_uptime_bitmap([fast_member, slow_member], True), ([], 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,10 +15,10 @@ try:
 except ImportError:
 	import Image
 import zipfile
-import shutil
 import re
 import time
 import os
+import StringIO
 from os.path import join
 
 log = logging.getLogger(__name__)
@@ -29,6 +29,9 @@ template_dir = join(os.path.dirname(__file__), 'docx-template')  # installed
 if not os.path.isdir(template_dir):
 	template_dir = join(os.path.dirname(__file__), 'template')  # dev
 
+# Images added by picture(), by name. savedocx writes them to word/media
+media = {}
+
 # All Word prefixes / namespace matches used in document.xml & core.xml.
 # LXML doesn't actually use prefixes (just the real namespace) , but these
 # make it easier to copy Word output more easily.
@@ -353,7 +356,7 @@ def figureCaption(captiontext, lang='en'):
 	paragraph.append(run8)
 	return paragraph
 
-def table(contents, heading=True, colw=None, cwunit='dxa', tblw=0, twunit='auto', borders={'all': {'color': 'auto', 'val': 'single', 'space': '0', 'sz': '4'}}, celstyle=None, headingFillColor='auto', firstColFillColor='auto'):
+def table(contents, heading=True, colw=None, cwunit='dxa', tblw=0, twunit='auto', borders={'all': {'color': 'auto', 'val': 'single', 'space': '0', 'sz': '4'}}, celstyle=None, headingFillColor='auto', firstColFillColor='auto', cellFillColors=None):
 	"""
 	Return a table element based on specified parameters
 
@@ -391,6 +394,9 @@ def table(contents, heading=True, colw=None, cwunit='dxa', tblw=0, twunit='auto'
 									documentation.
 	@param str  headingFillColor:  Specify a fill color for the first row of the table (if heading=True)
 	@param str  firstColFillColor: Specify a fill color for the first column of the table
+	@param list cellFillColors: A list of lists with a fill color (or None) for every cell
+				    of the content rows (so without the heading). Takes
+				    precedence over firstColFillColor
 	@return lxml.etree:   Generated XML etree element
 	"""
 	table = makeelement('tbl')
@@ -462,7 +468,7 @@ def table(contents, heading=True, colw=None, cwunit='dxa', tblw=0, twunit='auto'
 			i += 1
 		table.append(row)
 	# Contents Rows
-	for contentrow in contents[1 if heading else 0:]:
+	for r, contentrow in enumerate(contents[1 if heading else 0:]):
 		row = makeelement('tr')
 		i = 0
 		for content in contentrow:
@@ -475,7 +481,10 @@ def table(contents, heading=True, colw=None, cwunit='dxa', tblw=0, twunit='auto'
 				wattr = {'w': '0', 'type': 'auto'}
 			cellwidth = makeelement('tcW', attributes=wattr)
 			cellprops.append(cellwidth)
-			if i == 0:
+			if cellFillColors and cellFillColors[r][i]:
+				cellColor = makeelement('shd', attributes={'val': 'clear', 'color': 'auto', 'fill': cellFillColors[r][i]})
+				cellprops.append(cellColor)
+			elif i == 0:
 				cellColor = makeelement('shd', attributes={'val': 'clear', 'color': 'auto', 'fill': firstColFillColor})
 				cellprops.append(cellColor)
 			cell.append(cellprops)
@@ -496,7 +505,7 @@ def table(contents, heading=True, colw=None, cwunit='dxa', tblw=0, twunit='auto'
 		table.append(row)
 	return table
 
-def picture(relationshiplist, picname, picdescription, pixelwidth=None,	pixelheight=None, nochangeaspect=True, nochangearrowheads=True, jc='left'):
+def picture(relationshiplist, picname, picdescription, pixelwidth=None,	pixelheight=None, nochangeaspect=True, nochangearrowheads=True, jc='left', imagedata=None):
 	"""
 	Take a relationshiplist, picture file name, and return a paragraph
 	containing the image and an updated relationshiplist.
@@ -505,23 +514,27 @@ def picture(relationshiplist, picname, picdescription, pixelwidth=None,	pixelhei
 			  left, center, right, both (justified), ...
 			  see http://www.schemacentral.com/sc/ooxml/t-w_ST_Jc.html
 			  for a full list
+	@param string imagedata: Contents of the image. When given, picname is
+			  only used as the name of the image in the document
 	"""
 	# http://openxmldeveloper.org/articles/462.aspx
 	# Create an image. Size may be specified, otherwise it will based on the
 	# pixel size of image. Return a paragraph containing the picture'''
-	# Copy the file into the media dir
-	media_dir = join(template_dir, 'word', 'media')
-	if not os.path.isdir(media_dir):
-		os.mkdir(media_dir)
-	shutil.copyfile(picname, join(media_dir, os.path.basename(picname)))
+	# Keep the image in memory until savedocx writes it into the media dir
+	if imagedata is None:
+		imagefile = open(picname, 'rb')
+		imagedata = imagefile.read()
+		imagefile.close()
+	media[os.path.basename(picname)] = imagedata
 
 	# Check if the user has specified a size
+	if not pixelwidth or not pixelheight:
+		img_pixelwidth, img_pixelheight = Image.open(StringIO.StringIO(imagedata)).size[0:2]
 	if not pixelwidth and not pixelheight:
 		# If not, get info from the picture itself
-		pixelwidth, pixelheight = Image.open(picname).size[0:2]
+		pixelwidth, pixelheight = img_pixelwidth, img_pixelheight
 	# If only pixelwidth is provided, calculate pixelheigth with aspect ratio
 	if pixelwidth and not pixelheight:
-		img_pixelwidth, img_pixelheight = Image.open(picname).size[0:2]
 		aspect_ratio = float(pixelwidth) / float(img_pixelwidth)
 		pixelheight = int(round(img_pixelheight * aspect_ratio))
 
@@ -1039,6 +1052,14 @@ def savedocx(document, coreprops=None, appprops=None, contenttypes=None, websett
 		treestring = etree.tostring(tree, pretty_print=True)
 		docxfile.writestr(treesandfiles[tree], treestring)
 
+	# Add the images (already compressed)
+	media_files = {}
+	for picname in media:
+		media_files['word/media/' + picname] = media[picname]
+	for archivename in media_files:
+		log.info('Saving: %s' % archivename)
+		docxfile.writestr(zipfile.ZipInfo(archivename, time.localtime()[:6]), media_files[archivename])
+
 	# Add & compress support files
 	files_to_ignore = ['.DS_Store']  # nuisance from some os's
 	for dirpath, dirnames, filenames in os.walk('.'):
@@ -1047,9 +1068,12 @@ def savedocx(document, coreprops=None, appprops=None, contenttypes=None, websett
 				continue
 			templatefile = join(dirpath, filename)
 			archivename = templatefile[2:]
+			if archivename in media_files:
+				continue
 			log.info('Saving: %s', archivename)
 			docxfile.write(templatefile, archivename)
 	log.info('Saved new file to: %r', output)
 	docxfile.close()
+	media.clear()
 	os.chdir(prev_dir)  # restore previous working dir
 	return
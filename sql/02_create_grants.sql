@@ -1,7 +1,10 @@
 -- Run as user Zabbix
 grant usage on schema public to mios;
+grant select on history to mios;
 grant select on history_uint to mios;
 grant select on history_text to mios;
+grant select on trends to mios;
+grant select on trends_uint to mios;
 grant select on timeperiods to mios;
 grant select on maintenances_windows to mios;
 grant select on maintenances to mios;
@@ -10,3 +13,7 @@ grant select on groups to mios;
 grant select on hosts_groups to mios;
 grant select on hosts to mios;
 grant select on items to mios;
+grant select on events to mios;
+grant select on functions to mios;
+grant select on graphs to mios;
+grant select on graphs_items to mios;
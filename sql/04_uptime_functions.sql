@@ -0,0 +1,183 @@
+--As user mios uitvoeren
+-- Functions used by generate_report when uptime_engine=database is configured
+
+-- Converts a Zabbix item interval (60, 30s, 5m, 1h, 1d) to seconds. Same as convert_interval in generate_report:
+-- only the default interval of a flexible interval (1m;30s/1-5,09:00-18:00) is used and NULL is returned for user macros
+create or replace function mios_convert_interval(p_interval text) returns integer as $$
+  select case
+    when interval_part ~ '^[0-9]+$' then interval_part::integer
+    when interval_part ~ '^[0-9]+m$' then left(interval_part, -1)::integer * 60
+    when interval_part ~ '^[0-9]+h$' then left(interval_part, -1)::integer * 3600
+    when interval_part ~ '^[0-9]+d$' then left(interval_part, -1)::integer * 86400
+    when interval_part ~ '^[0-9]+[^0-9]$' then left(interval_part, -1)::integer
+    else null
+  end
+  from (select btrim(split_part(p_interval, ';', 1)) as interval_part) intervals
+$$ language sql immutable;
+
+-- Calculates the uptime of items between p_start and p_end (epoch). Returns one row per item with:
+--  - the total number of pollings
+--  - the number of down pollings (value = 0) in and NOT in maintenance
+--  - the number of pollings without data (gaps longer then 1.5 times the interval) in and NOT in maintenance
+--  - the merged downtime periods (consecutive down pollings and nodata gaps) as two arrays with start and end epochs
+create or replace function mios_uptime(p_itemids bigint[], p_start integer, p_end integer)
+returns table
+(
+  itemid bigint,
+  item_interval integer,
+  polling_total bigint,
+  pollings_down bigint,
+  pollings_down_maintenance bigint,
+  pollings_nodata bigint,
+  pollings_nodata_maintenance bigint,
+  downtime_starts integer[],
+  downtime_ends integer[]
+) as $$
+  with intervals as
+  (
+    -- Unknown intervals (user macros) use 60 seconds, like get_items_info in generate_report
+    select items.itemid, coalesce(mios_convert_interval(items.delay::text), 60) as item_interval
+    from items
+    where items.itemid = any(p_itemids)
+  ),
+  -- Only one time maintenance periods are used: recurring periods (daily, weekly, monthly) are not expanded like
+  -- expand_timeperiod does in generate_report
+  maintenance as
+  (
+    select distinct items.itemid, timeperiods.start_date as start_window, (timeperiods.start_date + timeperiods.period) as end_window
+    from timeperiods
+    inner join maintenances_windows on maintenances_windows.timeperiodid = timeperiods.timeperiodid
+    inner join maintenances on maintenances.maintenanceid = maintenances_windows.maintenanceid
+    inner join maintenances_groups on maintenances_groups.maintenanceid = maintenances.maintenanceid
+    inner join groups on maintenances_groups.groupid = groups.groupid
+    inner join hosts_groups on hosts_groups.groupid = groups.groupid
+    inner join hosts on hosts_groups.hostid = hosts.hostid
+    inner join items on items.hostid = hosts.hostid
+    where items.itemid = any(p_itemids) and timeperiods.timeperiod_type = 0 and timeperiods.start_date <= p_end and (timeperiods.start_date + timeperiods.period) >= p_start
+  ),
+  history as
+  (
+    select history_uint.itemid, history_uint.clock, history_uint.value
+    from history_uint
+    where history_uint.itemid = any(p_itemids) and history_uint.clock between p_start and p_end
+  ),
+  -- The clocks of the period plus the last clock before and the first clock after it, so gaps which cross the
+  -- start or the end of the period are found as well
+  gaps as
+  (
+    select clocks.itemid, clocks.clock, clocks.clock - lag(clocks.clock) over (partition by clocks.itemid order by clocks.clock) as difference
+    from
+    (
+      select history.itemid, history.clock from history
+      union all
+      select intervals.itemid, (select max(history_uint.clock) from history_uint where history_uint.itemid = intervals.itemid and history_uint.clock < p_start) from intervals
+      union all
+      select intervals.itemid, (select min(history_uint.clock) from history_uint where history_uint.itemid = intervals.itemid and history_uint.clock > p_end) from intervals
+    ) clocks
+    where clocks.clock is not null
+  ),
+  down as
+  (
+    select history.itemid, history.clock,
+      exists (select 1 from maintenance where maintenance.itemid = history.itemid and history.clock between maintenance.start_window and maintenance.end_window) as in_maintenance
+    from history
+    where history.value = 0
+  ),
+  -- Gaps are cut off at the period (p_end is its last second)
+  nodata as
+  (
+    select gaps.itemid, greatest(gaps.clock - gaps.difference, p_start) as start_nodata, least(gaps.clock, p_end + 1) as end_nodata, intervals.item_interval,
+      exists (select 1 from maintenance where maintenance.itemid = gaps.itemid and greatest(gaps.clock - gaps.difference, p_start) between maintenance.start_window and maintenance.end_window) as in_maintenance
+    from gaps
+    inner join intervals on intervals.itemid = gaps.itemid
+    where gaps.difference > intervals.item_interval + intervals.item_interval / 2 and gaps.clock > p_start and gaps.clock - gaps.difference <= p_end
+  ),
+  -- Gaps and islands: a new island of down pollings starts when the previous down polling is more then twice the interval ago.
+  -- Every down polling lasts one interval, the same as count_uptime_python in generate_report
+  down_islands as
+  (
+    select islands.itemid, min(islands.clock) as start_period,
+      max(islands.clock) + min(islands.item_interval) as end_period
+    from
+    (
+      select new_islands.itemid, new_islands.clock, new_islands.item_interval,
+        sum(new_islands.new_island) over (partition by new_islands.itemid order by new_islands.clock) as island
+      from
+      (
+        select down.itemid, down.clock, intervals.item_interval,
+          case when down.clock - lag(down.clock) over (partition by down.itemid order by down.clock) <= 2 * intervals.item_interval then 0 else 1 end as new_island
+        from down
+        inner join intervals on intervals.itemid = down.itemid
+      ) new_islands
+    ) islands
+    group by islands.itemid, islands.island
+  ),
+  periods as
+  (
+    select down_islands.itemid, down_islands.start_period, down_islands.end_period from down_islands
+    union all
+    select nodata.itemid, nodata.start_nodata, nodata.end_nodata from nodata
+  ),
+  -- Merge overlapping downtime periods. A period starts a new group when it starts after the end of all previous periods
+  merged_periods as
+  (
+    select period_groups.itemid, min(period_groups.start_period) as start_period, max(period_groups.end_period) as end_period
+    from
+    (
+      select new_groups.itemid, new_groups.start_period, new_groups.end_period,
+        sum(new_groups.new_group) over (partition by new_groups.itemid order by new_groups.start_period, new_groups.end_period) as period_group
+      from
+      (
+        select periods.itemid, periods.start_period, periods.end_period,
+          case when periods.start_period <= max(periods.end_period) over (partition by periods.itemid order by periods.start_period, periods.end_period rows between unbounded preceding and 1 preceding) then 0 else 1 end as new_group
+        from periods
+      ) new_groups
+    ) period_groups
+    group by period_groups.itemid, period_groups.period_group
+  ),
+  -- The counters are aggregated per item and joined to intervals. CTEs which are used more then once are materialized
+  -- without indexes, so subqueries per item would scan them once for every item
+  history_counts as
+  (
+    select history.itemid, count(*) as polling_total
+    from history
+    group by history.itemid
+  ),
+  down_counts as
+  (
+    select down.itemid,
+      sum(case when down.in_maintenance then 0 else 1 end) as pollings_down,
+      sum(case when down.in_maintenance then 1 else 0 end) as pollings_down_maintenance
+    from down
+    group by down.itemid
+  ),
+  nodata_counts as
+  (
+    select nodata.itemid,
+      sum(case when nodata.in_maintenance then 0 else (nodata.end_nodata - nodata.start_nodata) / nodata.item_interval end) as pollings_nodata,
+      sum(case when nodata.in_maintenance then (nodata.end_nodata - nodata.start_nodata) / nodata.item_interval else 0 end) as pollings_nodata_maintenance
+    from nodata
+    group by nodata.itemid
+  ),
+  period_arrays as
+  (
+    select merged_periods.itemid,
+      array_agg(merged_periods.start_period order by merged_periods.start_period) as downtime_starts,
+      array_agg(merged_periods.end_period order by merged_periods.start_period) as downtime_ends
+    from merged_periods
+    group by merged_periods.itemid
+  )
+  select intervals.itemid, intervals.item_interval,
+    coalesce(history_counts.polling_total, 0),
+    coalesce(down_counts.pollings_down, 0)::bigint,
+    coalesce(down_counts.pollings_down_maintenance, 0)::bigint,
+    coalesce(nodata_counts.pollings_nodata, 0)::bigint,
+    coalesce(nodata_counts.pollings_nodata_maintenance, 0)::bigint,
+    coalesce(period_arrays.downtime_starts, '{}'),
+    coalesce(period_arrays.downtime_ends, '{}')
+  from intervals
+  left join history_counts on history_counts.itemid = intervals.itemid
+  left join down_counts on down_counts.itemid = intervals.itemid
+  left join nodata_counts on nodata_counts.itemid = intervals.itemid
+  left join period_arrays on period_arrays.itemid = intervals.itemid
+$$ language sql stable;
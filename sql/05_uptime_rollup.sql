@@ -0,0 +1,18 @@
+--As user mios uitvoeren
+-- Daily uptime rollup used by generate_report when uptime_rollup=1 is configured
+-- The table is filled by generate_report (or with the --rollup option from cron). Only closed days are rolled up
+create table mios_uptime_daily
+(
+  itemid numeric(10,0) not null,
+  day date not null,
+  samples bigint not null,
+  down bigint not null,
+  down_in_maintenance bigint not null,
+  nodata_pollings bigint not null,
+  nodata_pollings_in_maintenance bigint not null,
+  downtime_starts integer[],
+  downtime_ends integer[],
+  constraint pk_mios_uptime_daily primary key (itemid, day)
+  using index tablespace mios_index
+)
+tablespace mios_table;
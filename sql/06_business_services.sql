@@ -0,0 +1,28 @@
+--As user mios uitvoeren
+-- Business services which are backed by several (redundant) items. Used by generate_report for the table in
+-- "Beschikbaarheid business services". operator 'or': the service is up when any of its items is up (redundant items),
+-- operator 'and': the service is up only when all of its items are up
+create table mios_report_services
+(
+  hostgroupid numeric(4,0) not null,
+  serviceid numeric(10,0) not null,
+  servicename character varying(100),
+  operator character varying(3) not null default 'or',
+  constraint pk_mios_report_services primary key (serviceid)
+  using index tablespace mios_index,
+  constraint ck_mios_report_services_operator check (operator in ('and', 'or'))
+)
+tablespace mios_table;
+
+create table mios_report_service_items
+(
+  serviceid numeric(10,0) not null,
+  itemid numeric(10,0) not null,
+  constraint pk_mios_report_service_items primary key (serviceid, itemid)
+  using index tablespace mios_index
+)
+tablespace mios_table;
+
+create sequence mios_report_services_seq start 1;
+
+create index mreportsrvc_hostgroupid on mios_report_services(hostgroupid);
@@ -0,0 +1,14 @@
+--As user mios uitvoeren
+-- Measured polling interval of the items, used by generate_report when uptime_interval_profiles=1 is configured
+-- The interval is the median time between two values in the last day of history. It replaces items.delay, which can
+-- be a flexible interval or a user macro
+create table mios_item_intervals
+(
+  itemid numeric(10,0) not null,
+  item_interval integer not null,
+  samples integer not null,
+  profiled_at integer not null,
+  constraint pk_mios_item_intervals primary key (itemid)
+  using index tablespace mios_index
+)
+tablespace mios_table;
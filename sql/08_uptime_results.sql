@@ -0,0 +1,25 @@
+--As user mios uitvoeren
+-- Uptime results of closed periods, used by generate_report when uptime_result_cache=1 is configured
+-- engine_version holds the version of generate_report and the settings of the uptime calculation, so results of
+-- another version or configuration are never reused
+create table mios_uptime_results
+(
+  itemid numeric(10,0) not null,
+  start_epoch integer not null,
+  end_epoch integer not null,
+  engine_version character varying(100) not null,
+  samples bigint not null,
+  down bigint not null,
+  down_in_maintenance bigint not null,
+  nodata_pollings bigint not null,
+  nodata_pollings_in_maintenance bigint not null,
+  percentage_up double precision not null,
+  percentage_down double precision not null,
+  percentage_down_maintenance double precision not null,
+  downtime_starts integer[],
+  downtime_ends integer[],
+  calculated_at integer not null,
+  constraint pk_mios_uptime_results primary key (itemid, start_epoch, end_epoch, engine_version)
+  using index tablespace mios_index
+)
+tablespace mios_table;